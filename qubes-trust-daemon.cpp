@@ -26,10 +26,12 @@
 #include <iostream>
 #include <exception>
 #include <algorithm>
+#include <vector>
 #include <unordered_map>
 #include <unordered_set>
 #include <ftw.h>
 #include <pwd.h>
+#include <poll.h>
 #include <errno.h>
 #include <fcntl.h>
 #include <limits.h>
@@ -38,8 +40,11 @@
 #include <string.h>
 #include <stdlib.h>
 #include <pthread.h>
+#include <sys/un.h>
 #include <sys/wait.h>
+#include <sys/stat.h>
 #include <sys/types.h>
+#include <sys/socket.h>
 #include <sys/inotify.h>
 
 /* 
@@ -71,11 +76,20 @@
 #define MAX_LEN 1024        // Path length for a directory
 #define MAX_EVENTS 1024     // Max. number of events to process at one go
 #define MAX_ARG_LEN 500     // Maximum amount of args passed to qvm-file-trust
+#define QUERY_TIMEOUT 2     // Seconds a client gets to send its query
+#define CHILD_POLL_PERIOD 50 // Milliseconds between checks on a child while
+                             // waiting for queries
 #define EVENT_SIZE (sizeof(struct inotify_event))	     // Size of one event
 #define BUF_LEN (MAX_EVENTS*(EVENT_SIZE + NAME_MAX + 1)) // Event data buffer
 
 int watch_fd;
 
+/*
+ * Listening socket that qvm-file-trust uses to ask about files we haven't
+ * marked yet. -1 if it couldn't be set up.
+ */
+int query_fd = -1;
+
 /*
  * Unordered map to keep track of watch descriptors and the absolute filepaths
  * that they correspond to 
@@ -88,6 +102,37 @@ std::unordered_map<int, std::string> watch_table;
  */
 std::unordered_set<std::string> untrusted_buffer;
 
+/*
+ * Files qvm-file-trust is marking as untrusted right now, they are no
+ * longer in untrusted_buffer but aren't marked yet
+ */
+std::unordered_set<std::string> marking_batch;
+
+/*
+ * Files a query has been told are untrusted, marked ahead of
+ * untrusted_buffer once the queries have their replies. They stay in here
+ * until they are marked.
+ */
+std::unordered_set<std::string> priority_buffer;
+
+/*
+ * Signifies whether a query is being answered, queries that come in
+ * meanwhile wait until it's done
+ */
+bool servingQueries;
+
+/*
+ * Signifies whether priority_buffer is being marked, files added meanwhile
+ * are picked up by the same run
+ */
+bool currentlyMarkingPriority;
+
+/*
+ * Signifies whether a rule list changed, the untrusted directories are
+ * walked again from the main loop rather than while answering a query
+ */
+bool rulesChanged;
+
 /*
  * Signifies whether the python client is currently being called.
  * Used to wake the client up again when we get new batches after a
@@ -105,6 +150,14 @@ std::unordered_set<std::string> untrusted_dirs;
  */
 std::string global_rules;
 std::string local_rules;
+std::string rules_state;
+std::string query_socket;
+
+/*
+ * Rules generation the watches were last placed for, see
+ * read_rules_generation()
+ */
+std::string watched_generation;
 
 /*
  * Helper function, string startswith
@@ -115,122 +168,130 @@ bool startsWith(const std::string& haystack, const std::string& needle) {
 }
 
 /*
- * Set a file or files as untrusted through qvm-file-trust
+ * Helper function, whether a path lies directly inside the folder with the
+ * given prefix, i.e. the folder followed by "/"
  */
-void mark_files_as_untrusted(const std::unordered_set<std::string> file_paths) {
-    if (currentlyMarkingFiles) {
-        std::cout << "Quitting because we're still running..." << std::endl;
-        return;
-    }
-
-    if (file_paths.empty()) {
-        std::cout << "No file paths provided, quitting..." << std::endl;
-        return;
-    }
+bool inFolder(const std::string& path, const std::string& prefix) {
+    return path.length() > prefix.length() && startsWith(path, prefix) &&
+        path.find('/', prefix.length()) == std::string::npos;
+}
 
-    currentlyMarkingFiles = true;
-    std::cout << "Marking " << file_paths.size() << " files as untrusted!" << std::endl;
+void serve_priority_queries();
 
-    pid_t child_pid;
+/*
+ * Wait for a child to exit. Unless a query is being answered already,
+ * queries that come in meanwhile are answered without waiting for it.
+ * Returns false if waiting failed.
+ */
+bool wait_for_child(const pid_t child_pid) {
     int exit_code;
 
-    // Convert set to array
-    // Modify to add extra arguments if necessary
-    int extra_args = 3;
-    const char* qvm_argv[MAX_ARG_LEN + extra_args];
-
-    // Add non-variable program arguments
-    qvm_argv[0] = "qvm-file-trust";
-    qvm_argv[1] = "--untrusted";
-
-    // Iterate through file path set and add to argv of qvm-file-trust
-    const char* file_path;
-
-    // Loop through list of arguments, processing MAX_ARG_LEN args each time
-    int iterations = file_paths.size() / MAX_ARG_LEN;
-    std::unordered_set<std::string>::const_iterator it = file_paths.begin();
-    std::cout << "Iterating..." << std::endl;
-    for (; iterations >= 0; iterations--) {
-        int arg_index = extra_args - 1;
-
-        // Build an array of MAX_ARG_LEN elements
-        std::cout << "Adding args..." << std::endl;
-        for (; arg_index < MAX_ARG_LEN + extra_args - 1; it++) {
-            // Stop and break from inner loop when we've hit the end
-            if (it == file_paths.end())
-                break;
-
-            file_path = (*it).c_str();
+    while (1) {
+        bool serve = query_fd >= 0 && !servingQueries;
+        pid_t result = waitpid(child_pid, &exit_code, serve ? WNOHANG : 0);
+        if (result == child_pid) {
+            return true;
+        }
+        if (result == -1) {
+            if (errno == EINTR) {
+                continue;
+            }
+            // Child has exited with error
+            perror("wait for qvm-file-trust failed");
+            return false;
+        }
 
-            printf("Marking untrusted:: %s\n", file_path);
+        // Still running, look out for queries for a little while
+        struct pollfd pfd = {query_fd, POLLIN, 0};
+        poll(&pfd, 1, CHILD_POLL_PERIOD);
+        serve_priority_queries();
+    }
+}
 
-            qvm_argv[arg_index] = file_path;
-            arg_index++;
-        }
-        std::cout << "Finished adding args..." << std::endl;
-
-        // Add NULL terminator to signal end of argument list
-        qvm_argv[arg_index] = (char*) NULL;
-
-        // Once we have a list of MAX_ARG_LEN args,
-        // fork and attempt to call qvm-file-trust
-        std::cout << "Forking!" << std::endl;
-        switch (child_pid=fork()) {
-            case 0:
-                // We're the child, call qvm-file-trust
-                execv("/usr/bin/qvm-file-trust", (char**) qvm_argv);
-
-                // Unreachable if no error
-                perror("execl qvm-file-trust failed");
-                exit(1);
-            case -1:
-                // Fork failed
-                perror("fork failed");
-                return;
-            default:
-                // Fork succeeded, and we got our pid, wait until child exits
-                std::cout << "Waiting for the child..." << std::endl;
-                if (waitpid(child_pid, &exit_code, 0) == -1) {
-                    // Child has exited with error
-                    perror("wait for qvm-file-trust failed");
-                    std::cout << "Failed!" << std::endl;
-
-                    // Return and try these files again later
-                    currentlyMarkingFiles = false;
-                    return;
-                }
+/*
+ * Call qvm-file-trust once to mark the given files as untrusted.
+ * Returns false if the files should be tried again later.
+ */
+bool run_qvm_file_trust(const std::vector<std::string>& file_paths) {
+    pid_t child_pid;
 
-                std::cout << "Didn't fail!" << std::endl;
+    // Add non-variable program arguments
+    std::vector<const char*> qvm_argv;
+    qvm_argv.push_back("qvm-file-trust");
+    qvm_argv.push_back("--untrusted");
+
+    // Add each file path to argv of qvm-file-trust
+    for (const std::string& file_path : file_paths) {
+        printf("Marking untrusted:: %s\n", file_path.c_str());
+        qvm_argv.push_back(file_path.c_str());
+    }
 
-                if (!untrusted_buffer.empty()) {
-                    // Remove these files from the untrusted_buffer
-                    // Advance by the number of marked files
-                    int starting_index = arg_index - extra_args + 1;
-                    std::unordered_set<std::string>::iterator it = untrusted_buffer.begin();
-                    std::advance(it, starting_index);
+    // Add NULL terminator to signal end of argument list
+    qvm_argv.push_back((char*) NULL);
+
+    std::cout << "Forking!" << std::endl;
+    switch (child_pid=fork()) {
+        case 0:
+            // We're the child, call qvm-file-trust
+            execv("/usr/bin/qvm-file-trust", (char**) qvm_argv.data());
+
+            // Unreachable if no error
+            perror("execl qvm-file-trust failed");
+            exit(1);
+        case -1:
+            // Fork failed
+            perror("fork failed");
+            return false;
+        default:
+            // Fork succeeded, and we got our pid, wait until child exits
+            std::cout << "Waiting for the child..." << std::endl;
+            return wait_for_child(child_pid);
+    }
+}
 
-                    std::cout << "Buffer size: " << untrusted_buffer.size() << std::endl;
-                    std::cout << "Advanced by " << arg_index + 1 - extra_args << std::endl;
+/*
+ * Set all files in untrusted_buffer as untrusted through qvm-file-trust,
+ * MAX_ARG_LEN files at a time
+ */
+void mark_files_as_untrusted() {
+    if (currentlyMarkingFiles) {
+        std::cout << "Quitting because we're still running..." << std::endl;
+        return;
+    }
 
-                    // Create a new buffer with the new items, faster than deleting
-                    std::unordered_set<std::string> new_untrusted_buffer;
-                    for (; it != untrusted_buffer.end(); it++) {
-                        std::cout << "Running: " << (*it) << std::endl;
-                        new_untrusted_buffer.insert((*it));
-                    }
+    if (untrusted_buffer.empty()) {
+        std::cout << "No file paths provided, quitting..." << std::endl;
+        return;
+    }
 
-                    std::cout << "Old buffer size: " << untrusted_buffer.size() << std::endl;
-                    untrusted_buffer = new_untrusted_buffer;
-                    std::cout << "New buffer size: " << untrusted_buffer.size() << std::endl;
+    currentlyMarkingFiles = true;
+    std::cout << "Marking " << untrusted_buffer.size() << " files as untrusted!" << std::endl;
+
+    while (!untrusted_buffer.empty()) {
+        // Take the next MAX_ARG_LEN files off the buffer
+        std::vector<std::string> batch;
+        std::unordered_set<std::string>::iterator it = untrusted_buffer.begin();
+        while (it != untrusted_buffer.end() && batch.size() < MAX_ARG_LEN) {
+            batch.push_back(*it);
+            it = untrusted_buffer.erase(it);
+        }
 
-                    // Clean up
-                    currentlyMarkingFiles = false;
-                    mark_files_as_untrusted(untrusted_buffer);
-                }
+        // Queries answered while the batch is marked still count these
+        marking_batch.insert(batch.begin(), batch.end());
+        bool marked = run_qvm_file_trust(batch);
+        marking_batch.clear();
 
-            currentlyMarkingFiles = false;
+        if (!marked) {
+            // Put them back and try these files again later
+            untrusted_buffer.insert(batch.begin(), batch.end());
+            break;
         }
+
+        // Let interactive checks jump ahead of the rest of the backlog
+        serve_priority_queries();
     }
+
+    currentlyMarkingFiles = false;
 }
 
 /*
@@ -294,6 +355,9 @@ int watch_dir(const char *filepath, const struct stat *info,
     std::ignore = typeflag;
     std::ignore = pathinfo;
 
+    // Walks of large folders take a while, keep answering queries
+    serve_priority_queries();
+
     // Watch directories, set files as untrusted
     struct stat s;
     if(stat(filepath, &s) == 0) {
@@ -333,9 +397,7 @@ int place_watch_on_dir_and_subdirs(const char* const filepath) {
         errno = result;
     }
 
-    // Mark any found files as untrusted
     std::cout << "Finished running. untrusted_buffer is now size: " << untrusted_buffer.size() << std::endl;
-    mark_files_as_untrusted(untrusted_buffer);
 
     return errno;
 }
@@ -366,14 +428,40 @@ std::unordered_set<std::string> get_untrusted_dir_list() {
     return rules;
 }
 
+/*
+ * Read the current rules generation from the state file qvm-file-trust
+ * keeps. Its first line starts with the generation and rules digest.
+ * Returns an empty string if there is no state file.
+ */
+std::string read_rules_generation() {
+    std::ifstream state_file(rules_state);
+    std::string generation, digest;
+
+    if (!(state_file >> generation >> digest)) {
+        return "";
+    }
+
+    return generation + " " + digest;
+}
+
 /*
  * Retrieve the list of untrusted dirs and place a watch on
  * it and its subdirs.
  */
 void watch_untrusted_dir_list() {
-    // Get the list of all untrusted directories
+    // Get the list of all untrusted directories. This also brings the
+    // rules generation up to date.
     untrusted_dirs = get_untrusted_dir_list();
 
+    // Rule lists are often written several times per save, only walk the
+    // untrusted directories again if the rules actually changed
+    std::string generation = read_rules_generation();
+    if (!generation.empty() && generation == watched_generation) {
+        std::cout << "Rules unchanged, keeping existing watches" << std::endl;
+        return;
+    }
+    watched_generation = generation;
+
     // Add a watch to each untrusted directory and their subdirectories
     std::unordered_set<std::string>::iterator it;
     std::string dir;
@@ -381,90 +469,348 @@ void watch_untrusted_dir_list() {
         dir = *it;
         place_watch_on_dir_and_subdirs(dir.c_str());
     }
+
+    // Mark any found files as untrusted
+    mark_files_as_untrusted();
 }
 
-/* 
- * Watches directories and acts on various spawned inotify events
+/*
+ * Read one buffer of inotify events and act on them. New files are only
+ * queued in untrusted_buffer, the caller decides when to mark them.
  */
-void keep_watch_on_dirs(const int fd) {
-    while(1) {
-        char buffer[BUF_LEN];
-        int length = read(fd, buffer, BUF_LEN);
-        int i = 0;
+void handle_inotify_events(const int fd) {
+    char buffer[BUF_LEN];
+    int length = read(fd, buffer, BUF_LEN);
+    int i = 0;
 
-        if (length <= 0) {
-            perror("read");
+    if (length <= 0) {
+        perror("read");
+    }
+
+    /* Read the events*/
+    while (i < length) {
+        struct inotify_event* event = (struct inotify_event*) &buffer[i];
+        std::string filepath = watch_table[event->wd];
+        i += EVENT_SIZE + event->len;
+
+        // Ignore empty filepaths
+        if (filepath.empty()) {
+            continue;
         }
 
-        /* Read the events*/
-        while (i < length) {
-            struct inotify_event* event = (struct inotify_event*) &buffer[i];
-            std::string filepath = watch_table[event->wd];
+        std::string fullpath = filepath + "/" + event->name;
 
-            // Ignore empty filepaths
-            if (filepath.empty()) {
-                continue;
+
+        std::cout << "Got event with mask: " << event->mask << std::endl;
+        if (event->mask & IN_CREATE) {
+            // Get absolute filepath from our global watch_table
+            if (event->mask & IN_ISDIR) {
+                printf("%d DIR::%s CREATED\n", event->wd, fullpath.c_str());
+                place_watch_on_dir_and_subdirs(fullpath.c_str());
+            } else {
+                printf("%d FILE::%s CREATED\n", event->wd, fullpath.c_str());
+                // Mark file to be set as untrusted
+                untrusted_buffer.insert(fullpath);
             }
+        }
 
-            std::string fullpath = filepath + "/" + event->name;
+        if (event->mask & IN_MOVED_TO) {
+            if (event->mask & IN_ISDIR) {
+                printf("%d DIR::%s MOVED IN\n", event->wd, fullpath.c_str());
+                place_watch_on_dir_and_subdirs(fullpath.c_str());
+            } else {
+                printf("%d FILE::%s MOVED IN\n", event->wd, fullpath.c_str());
+                // Mark file to be set as untrusted
+                untrusted_buffer.insert(fullpath);
+            }
+        }
 
+        if (event->mask & IN_MOVED_FROM || event->mask & IN_MOVE_SELF) {
+            if (event->mask & IN_ISDIR) {
+                printf("%d DIR::%s MOVED OUT\n", event->wd, fullpath.c_str());
 
-            std::cout << "Got event with mask: " << event->mask << std::endl;
-            if (event->mask & IN_CREATE) {
-                // Get absolute filepath from our global watch_table
-                if (event->mask & IN_ISDIR) {
-                    printf("%d DIR::%s CREATED\n", event->wd, fullpath.c_str());
-                    place_watch_on_dir_and_subdirs(fullpath.c_str());
-                } else {
-                    printf("%d FILE::%s CREATED\n", event->wd, fullpath.c_str());
-                    // Mark file to be set as untrusted
-                    untrusted_buffer.insert(fullpath);
-                    mark_files_as_untrusted(untrusted_buffer);
-                }
+                // Recursive rm watch
+                rec_rm_watch(fullpath);
+            } else {
+                printf("%d FILE::%s MOVED OUT\n", event->wd, fullpath.c_str());
             }
+        }
 
-            if (event->mask & IN_MOVED_TO) {
-                if (event->mask & IN_ISDIR) {
-                    printf("%d DIR::%s MOVED IN\n", event->wd, fullpath.c_str());
-                    place_watch_on_dir_and_subdirs(fullpath.c_str());
-                } else {
-                    printf("%d FILE::%s MOVED IN\n", event->wd, fullpath.c_str());
-                    // Mark file to be set as untrusted
-                    untrusted_buffer.insert(fullpath);
-                    mark_files_as_untrusted(untrusted_buffer);
+        if (event->mask & IN_MODIFY || event->mask & IN_DELETE_SELF) {
+            if (event->mask & IN_ISDIR) {
+                printf("%d DIR::%s MODIFIED\n", event->wd, fullpath.c_str());
+            } else {
+                printf("%d FILE::%s MODIFIED\n", event->wd, fullpath.c_str());
+
+                // Remove "/" from end of filepath
+                fullpath.pop_back();
+
+                // Check if a rule list was modified. The new rules can mean
+                // a long walk and marking, which the main loop takes care of
+                if (fullpath.find(global_rules) != std::string::npos ||
+                    fullpath.find(local_rules) != std::string::npos) {
+                    printf("Rule list updated, reloading rule lists...\n");
+                    rulesChanged = true;
                 }
             }
+        }
+    }
+}
+
+/*
+ * Handle any inotify events that have already arrived, without blocking
+ */
+void drain_inotify_events() {
+    struct pollfd pfd = {watch_fd, POLLIN, 0};
+
+    while (poll(&pfd, 1, 0) > 0 && (pfd.revents & POLLIN)) {
+        handle_inotify_events(watch_fd);
+    }
+}
+
+/*
+ * Send the whole of a reply to a client
+ */
+void send_reply(const int client_fd, const std::string& reply) {
+    size_t sent = 0;
+    while (sent < reply.length()) {
+        ssize_t length = send(client_fd, reply.data() + sent,
+                reply.length() - sent, MSG_NOSIGNAL);
+        if (length == -1) {
+            if (errno == EINTR) {
+                continue;
+            }
+            perror("send");
+            return;
+        }
+        sent += length;
+    }
+}
 
-            if (event->mask & IN_MOVED_FROM || event->mask & IN_MOVE_SELF) {
-                if (event->mask & IN_ISDIR) {
-                    printf("%d DIR::%s MOVED OUT\n", event->wd, fullpath.c_str());
+/*
+ * Answer a LIST query for a folder with the names of the files directly
+ * inside it that are waiting to be marked or being marked, each followed
+ * by a NUL, then a newline. Waiting ones jump the queue, as in
+ * answer_query().
+ */
+void answer_list_query(const int client_fd, std::string dir) {
+    // Remove "/" from end of folder, keeping the root folder
+    while (dir.length() > 1 && dir.back() == '/') {
+        dir.pop_back();
+    }
+    std::string prefix = dir == "/" ? dir : dir + "/";
+
+    std::string reply;
+    for (std::unordered_set<std::string>::iterator it =
+            untrusted_buffer.begin(); it != untrusted_buffer.end();) {
+        if (inFolder(*it, prefix)) {
+            priority_buffer.insert(*it);
+            it = untrusted_buffer.erase(it);
+        } else {
+            ++it;
+        }
+    }
+    for (const std::unordered_set<std::string>* files :
+            {&priority_buffer, &marking_batch}) {
+        for (const std::string& file_path : *files) {
+            if (inFolder(file_path, prefix)) {
+                reply += file_path.substr(prefix.length());
+                reply += '\0';
+            }
+        }
+    }
+    reply += '\n';
 
-                    // Recursive rm watch
-                    rec_rm_watch(fullpath);
-                } else {
-                    printf("%d FILE::%s MOVED OUT\n", event->wd, fullpath.c_str());
-                }
+    send_reply(client_fd, reply);
+}
+
+/*
+ * Answer a single query from qvm-file-trust. The client sends an absolute
+ * path followed by a newline. If that path is waiting to be marked or
+ * being marked we reply UNTRUSTED, and a waiting one is moved to
+ * priority_buffer to be marked once the queries are answered. Otherwise we
+ * reply UNKNOWN and the client's own checks are authoritative.
+ * "LIST " followed by a folder asks about a whole folder at once, see
+ * answer_list_query().
+ */
+void answer_query(const int client_fd) {
+    struct timeval timeout = {QUERY_TIMEOUT, 0};
+    setsockopt(client_fd, SOL_SOCKET, SO_RCVTIMEO, &timeout, sizeof(timeout));
+
+    // Read the path up to the first newline
+    std::string path;
+    char buf[PATH_MAX];
+    bool complete = false;
+    while (!complete && path.length() < PATH_MAX) {
+        int length = read(client_fd, buf, sizeof(buf));
+        if (length <= 0) {
+            break;
+        }
+
+        char* newline = (char*) memchr(buf, '\n', length);
+        if (newline != NULL) {
+            length = newline - buf;
+            complete = true;
+        }
+        path.append(buf, length);
+    }
+
+    if (!complete) {
+        std::cout << "Dropping incomplete query" << std::endl;
+        return;
+    }
+
+    // Pick up files whose events we haven't read yet
+    drain_inotify_events();
+
+    if (startsWith(path, "LIST ")) {
+        answer_list_query(client_fd, path.substr(5));
+        return;
+    }
+
+    const char* reply = "UNKNOWN\n";
+    std::unordered_set<std::string>::iterator it = untrusted_buffer.find(path);
+    if (it != untrusted_buffer.end()) {
+        // Mark it ahead of the rest of the buffer
+        reply = "UNTRUSTED\n";
+        priority_buffer.insert(path);
+        untrusted_buffer.erase(it);
+    } else if (priority_buffer.count(path) || marking_batch.count(path)) {
+        // Already on its way
+        reply = "UNTRUSTED\n";
+    }
+
+    send_reply(client_fd, reply);
+}
+
+/*
+ * Mark the files in priority_buffer as untrusted, MAX_ARG_LEN at a time.
+ * Files that fail go back to untrusted_buffer for the next run over it.
+ */
+void mark_priority_files() {
+    if (currentlyMarkingPriority) {
+        return;
+    }
+
+    currentlyMarkingPriority = true;
+    while (!priority_buffer.empty()) {
+        // Leave the batch in priority_buffer until it's marked, so queries
+        // answered meanwhile still count it
+        std::vector<std::string> batch;
+        for (const std::string& file_path : priority_buffer) {
+            if (batch.size() >= MAX_ARG_LEN) {
+                break;
             }
+            printf("Priority marking:: %s\n", file_path.c_str());
+            batch.push_back(file_path);
+        }
 
-            if (event->mask & IN_MODIFY || event->mask & IN_DELETE_SELF) {
-                if (event->mask & IN_ISDIR) {
-                    printf("%d DIR::%s MODIFIED\n", event->wd, fullpath.c_str());
-                } else {
-                    printf("%d FILE::%s MODIFIED\n", event->wd, fullpath.c_str());
-
-                    // Remove "/" from end of filepath
-                    fullpath.pop_back();
-
-                    // Check if a rule list was modified
-                    if (fullpath.find(global_rules) != std::string::npos ||
-                        fullpath.find(local_rules) != std::string::npos) {
-                        printf("Rule list updated, reloading rule lists...\n");
-                        watch_untrusted_dir_list();
-                    }
-                }
+        bool marked = run_qvm_file_trust(batch);
+        for (const std::string& file_path : batch) {
+            priority_buffer.erase(file_path);
+        }
+
+        if (!marked) {
+            untrusted_buffer.insert(batch.begin(), batch.end());
+            break;
+        }
+    }
+    currentlyMarkingPriority = false;
+}
+
+/*
+ * Answer every query currently waiting on the query socket, then mark the
+ * files they were told are untrusted
+ */
+void serve_priority_queries() {
+    if (query_fd < 0 || servingQueries) {
+        return;
+    }
+
+    servingQueries = true;
+    int client_fd;
+    while ((client_fd = accept(query_fd, NULL, NULL)) != -1) {
+        answer_query(client_fd);
+        close(client_fd);
+    }
+    servingQueries = false;
+
+    mark_priority_files();
+}
+
+/*
+ * Create the non-blocking socket qvm-file-trust sends queries to.
+ * Returns -1 on failure, the daemon then works without it.
+ */
+int open_query_socket(const std::string& socket_path) {
+    struct sockaddr_un addr;
+    memset(&addr, 0, sizeof(addr));
+    addr.sun_family = AF_UNIX;
+
+    if (socket_path.length() >= sizeof(addr.sun_path)) {
+        std::cerr << "Query socket path too long: " << socket_path << std::endl;
+        return -1;
+    }
+    strncpy(addr.sun_path, socket_path.c_str(), sizeof(addr.sun_path) - 1);
+
+    int fd = socket(AF_UNIX, SOCK_STREAM | SOCK_NONBLOCK | SOCK_CLOEXEC, 0);
+    if (fd == -1) {
+        perror("socket");
+        return -1;
+    }
+
+    // Remove a socket left behind by a previous run
+    unlink(socket_path.c_str());
+
+    if (bind(fd, (struct sockaddr*) &addr, sizeof(addr)) == -1 ||
+        chmod(socket_path.c_str(), 0600) == -1 ||
+        listen(fd, SOMAXCONN) == -1) {
+        perror("Unable to set up query socket");
+        close(fd);
+        return -1;
+    }
+
+    return fd;
+}
+
+/* 
+ * Watches directories and acts on various spawned inotify events, as well
+ * as queries from qvm-file-trust
+ */
+void keep_watch_on_dirs(const int fd) {
+    struct pollfd fds[2];
+    fds[0].fd = fd;
+    fds[0].events = POLLIN;
+    fds[1].fd = query_fd;
+    fds[1].events = POLLIN;
+
+    while(1) {
+        // Catch up on anything seen while answering a query before blocking,
+        // as those events have already been read off the inotify descriptor
+        if (rulesChanged) {
+            rulesChanged = false;
+            watch_untrusted_dir_list();
+        }
+
+        if (!untrusted_buffer.empty()) {
+            mark_files_as_untrusted();
+        }
+
+        // Don't block if the rule lists changed while marking the files
+        if (poll(fds, query_fd < 0 ? 1 : 2, rulesChanged ? 0 : -1) == -1) {
+            if (errno != EINTR) {
+                perror("poll");
             }
+            continue;
+        }
+
+        // Answer queries first, they come from interactive checks
+        if (query_fd >= 0 && (fds[1].revents & POLLIN)) {
+            serve_priority_queries();
+        }
 
-            i += EVENT_SIZE + event->len;
+        if (fds[0].revents & POLLIN) {
+            handle_inotify_events(fd);
         }
     }
 }
@@ -485,14 +831,30 @@ int main(void) {
     global_rules = "/etc/qubes/always-open-in-dispvm.list";
     local_rules = std::string(homedir) +
         "/.config/qubes/always-open-in-dispvm.list";
+    rules_state = std::string(homedir) +
+        "/.config/qubes/always-open-in-dispvm.state";
+    query_socket = std::string(homedir) +
+        "/.config/qubes/qubes-trust-daemon.sock";
+
+    // Create ~/.config/qubes if it doesn't exist yet
+    mkdir((std::string(homedir) + "/.config").c_str(), 0700);
+    mkdir((std::string(homedir) + "/.config/qubes").c_str(), 0700);
+
+    // Listen for queries before the initial scan, so checks made during a
+    // long first batch can already jump the queue
+    query_fd = open_query_socket(query_socket);
 
     watch_untrusted_dir_list();
 
     // Monitor inotify for file events
     keep_watch_on_dirs(watch_fd);
 
-    // Clean up left-over descriptor
+    // Clean up left-over descriptors
     close(watch_fd);
+    if (query_fd >= 0) {
+        close(query_fd);
+        unlink(query_socket.c_str());
+    }
 
     return 0;
 }
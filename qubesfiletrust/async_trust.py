@@ -0,0 +1,75 @@
+# -*- coding: utf-8 -*-
+#
+# The Qubes OS Project, http://www.qubes-os.org
+#
+# Copyright (C) 2017 Andrew Morgan <andrew@amorgan.xyz>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+#
+#
+
+"""Check file and folder trust from an asyncio event loop, such as a file
+manager extension's, without blocking it."""
+
+import asyncio
+import concurrent.futures
+
+from qubesfiletrust import qvm_file_trust
+
+DEFAULT_WORKERS = 8
+
+async def check_many(paths, workers=DEFAULT_WORKERS, executor=None):
+    """Check the trust of many paths, yielding a TrustVerdict for each.
+
+    The checks run in executor, or a thread pool of the given number of
+    workers, with at most that many in flight at once. Verdicts are yielded
+    as soon as they are ready, so not necessarily in the order of paths.
+    Each call sees changes made since the last, see refresh_caches().
+
+    Cancelling the task iterating over this, or closing it, cancels the
+    checks that haven't started yet.
+    """
+
+    loop = asyncio.get_running_loop()
+    own_executor = executor is None
+    if own_executor:
+        executor = concurrent.futures.ThreadPoolExecutor(workers)
+
+    paths = iter(paths)
+    pending = set()
+    try:
+        # Pick up rule, marker and symlink changes made since the last batch
+        await loop.run_in_executor(executor, qvm_file_trust.refresh_caches)
+
+        while True:
+            # Keep up to workers checks going
+            for path in paths:
+                pending.add(loop.run_in_executor(executor,
+                        qvm_file_trust.evaluate_path, path))
+                if len(pending) >= workers:
+                    break
+
+            if not pending:
+                break
+
+            done, pending = await asyncio.wait(pending,
+                    return_when=asyncio.FIRST_COMPLETED)
+            for future in done:
+                yield future.result()
+    finally:
+        for future in pending:
+            future.cancel()
+        if own_executor:
+            executor.shutdown(wait=False)
@@ -25,16 +25,90 @@
 trust levels."""
 
 import sys
+import json
 import argparse
 import os
+import mmap
+import stat
+import time
+import errno
+import fcntl
 import xattr
+import struct
+import tempfile
+import hashlib
+import socket
 import subprocess
+import collections
 import multiprocessing
+import concurrent.futures
 
-UNTRUSTED_PHRASE = ""
 PHRASE_FILE_LOC = '/etc/qubes/always-open-in-dispvm.phrase'
 GLOBAL_FOLDER_LOC = '/etc/qubes/always-open-in-dispvm.list'
 LOCAL_FOLDER_LOC = os.path.expanduser('~') + '/.config/qubes/always-open-in-dispvm.list'
+RULES_STATE_LOC = os.path.expanduser('~') + '/.config/qubes/always-open-in-dispvm.state'
+RULES_HISTORY_LENGTH = 32
+GLOBAL_UNTRUSTED_HASHES_LOC = '/etc/qubes/always-open-in-dispvm.sha256'
+LOCAL_UNTRUSTED_HASHES_LOC = os.path.expanduser('~') + '/.config/qubes/always-open-in-dispvm.sha256'
+GLOBAL_TRUSTED_HASHES_LOC = '/etc/qubes/never-open-in-dispvm.sha256'
+LOCAL_TRUSTED_HASHES_LOC = os.path.expanduser('~') + '/.config/qubes/never-open-in-dispvm.sha256'
+DIGEST_INDEX_LOC = os.path.expanduser('~') + '/.config/qubes/qubes-trust-digests'
+DIGEST_INDEX_MAX_SIZE = 1 << 20
+QUBES_INCOMING_LOC = os.path.expanduser('~') + '/QubesIncoming'
+DAEMON_SOCKET_LOC = os.path.expanduser('~') + '/.config/qubes/qubes-trust-daemon.sock'
+DAEMON_TIMEOUT = 5
+QVM_OPEN_IN_VM_LOC = '/usr/bin/qvm-open-in-vm'
+OPEN_IN_DISPVM_JOBS = 4
+HASH_JOBS = os.cpu_count() or 1
+HASH_PARALLEL_MIN = 16
+OUTPUT_CHUNK_SIZE = 1024
+
+# Contents of the 'user.qubes.untrusted' xattr. Stored as a version byte,
+# flags, the permissions a file had before it was locked, when it was
+# marked, then the lengths and bytes of the origin qube and the rule that
+# caused the marking. The legacy values 'true' and 'false' are still read.
+TrustRecord = collections.namedtuple('TrustRecord',
+        ['untrusted', 'origin', 'timestamp', 'rule', 'mode'])
+TRUST_RECORD_VERSION = 1
+TRUST_RECORD_HEADER = struct.Struct('!BBHqBH')
+TRUST_RECORD_UNTRUSTED = 0x01
+TRUST_RECORD_HAS_MODE = 0x02
+
+# Outcome of checking a single path. untrusted is None if the check failed,
+# source names the check that decided it, if any
+TrustVerdict = collections.namedtuple('TrustVerdict',
+        ['path', 'untrusted', 'source', 'error'])
+
+# Folder path -> whether it inherits untrusted status from an xattr
+FOLDER_TRUST_CACHE = {}
+
+# Folder path -> the same path with all symlinks resolved
+REALPATH_CACHE = {}
+
+# Most folders FOLDER_TRUST_CACHE or REALPATH_CACHE hold before they are
+# emptied, so checking a huge number of paths doesn't build them up
+FOLDER_CACHE_SIZE = 4096
+
+# (untrusted folder paths, both absolute and canonical, upper-cased untrusted
+# phrase), loaded on first use by load_untrusted_rules()
+UNTRUSTED_RULES = None
+
+# Rules generation that UNTRUSTED_RULES was loaded at, see rules_generation()
+UNTRUSTED_RULES_GENERATION = None
+
+# (trusted digests, untrusted digests), loaded on first use by
+# load_hash_lists()
+HASH_LISTS = None
+
+# Stamps of the hash lists HASH_LISTS was loaded from, see file_stamps()
+HASH_LISTS_STAMPS = None
+
+# (st_dev, st_ino, st_mtime_ns, st_size) -> SHA-256 hex digest
+DIGEST_CACHE = {}
+
+# (st_dev, st_ino, st_size, st_mtime_ns, st_ctime_ns) -> SHA-256 hex digest
+# of locked files, loaded on first use by locked_digest()
+LOCKED_DIGESTS = None
 
 OUTPUT_QUIET = False
 UNTRUSTED_PATH_FOUND = False
@@ -111,8 +185,8 @@ def retrieve_untrusted_folders():
                     # Support explicitly trusting folders by prepending with -
                     if line.startswith('-'):
                         # Remove any mention of this path from the existing 
-                        # list later
-                        untrusted_paths.remove(os.path.expanduser(line[1:]))
+                        # list later, if it's there at all
+                        untrusted_paths.discard(os.path.expanduser(line[1:]))
                     else:
                         untrusted_paths.add(os.path.expanduser(line))
 
@@ -122,9 +196,572 @@ def retrieve_untrusted_folders():
 
     return list(untrusted_paths)
 
+def retrieve_untrusted_phrase():
+    """Read the untrusted phrase from /etc/qubes/always-open-in-dispvm.phrase
+
+    Returns an empty string if no phrase is set.
+    """
+
+    try:
+        with open(PHRASE_FILE_LOC) as phrase_file:
+            for line in phrase_file.readlines():
+                line = line.rstrip()
+
+                # Ignore comments
+                if not line.startswith('#'):
+                    return line
+
+    except:
+        serror('Unable to open phrase file: {}'.
+                format(PHRASE_FILE_LOC))
+
+    return ""
+
+def canonical_path(path):
+    """Return the absolute form of a path with all symlinks resolved.
+
+    The containing folder is resolved through REALPATH_CACHE, so checking
+    many files in the same folder only resolves it once, and a folder that
+    isn't cached only costs a look at itself once its parent is.
+    """
+
+    path = os.path.abspath(path)
+    parent, name = os.path.split(path)
+
+    # The root folder
+    if not name:
+        return path
+
+    real_parent = REALPATH_CACHE.get(parent)
+    if real_parent is None:
+        real_parent = canonical_path(parent)
+        if len(REALPATH_CACHE) >= FOLDER_CACHE_SIZE:
+            REALPATH_CACHE.clear()
+        REALPATH_CACHE[parent] = real_parent
+
+    real_path = os.path.join(real_parent, name)
+    if os.path.islink(real_path):
+        real_path = os.path.realpath(real_path)
+
+    return real_path
+
+def file_stamps(*locs):
+    """Return a string identifying the current version of each given file,
+    from their inode, size and modification time"""
+
+    stamps = []
+    for loc in locs:
+        try:
+            file_stat = os.stat(loc)
+            stamps.append('{}:{}:{}'.format(file_stat.st_ino,
+                    file_stat.st_size, file_stat.st_mtime_ns))
+        except OSError:
+            stamps.append('-')
+
+    return ' '.join(stamps)
+
+def rules_stamps():
+    """Return the stamps of the rule files, see file_stamps()"""
+
+    return file_stamps(GLOBAL_FOLDER_LOC, LOCAL_FOLDER_LOC, PHRASE_FILE_LOC)
+
+def read_rules_state(header_only=False):
+    """Read the rules state file, see update_rules_state().
+
+    Returns a dict with 'generation', 'digest', 'oldest' and 'stamps', plus
+    'folders', 'phrase' and 'history' unless header_only is set. Returns
+    None if there is no readable state.
+    """
+
+    try:
+        with open(RULES_STATE_LOC) as state_file:
+            generation, digest, oldest = state_file.readline().split()
+            state = {'generation': int(generation), 'digest': digest,
+                     'oldest': int(oldest),
+                     'stamps': state_file.readline().rstrip('\n')}
+            if header_only:
+                return state
+
+            state['folders'] = set()
+            state['phrase'] = ''
+            state['history'] = []
+            for line in state_file:
+                line = line.rstrip('\n')
+                if line.startswith('='):
+                    state['folders'].add(line[1:])
+                elif line.startswith('*'):
+                    state['phrase'] = line[1:]
+                elif line[:1] in ('+', '-', '~'):
+                    line_generation, value = line[1:].split(' ', 1)
+                    state['history'].append(
+                            (int(line_generation), line[0], value))
+    except (OSError, ValueError):
+        return None
+
+    return state
+
+def lock_rules_state():
+    """Take an exclusive lock on the rules state file, waiting for any other
+    process holding it. Returns the open lock file, closing it releases the
+    lock, or None if it couldn't be locked."""
+
+    try:
+        os.makedirs(os.path.dirname(RULES_STATE_LOC), exist_ok=True)
+        lock_file = open(RULES_STATE_LOC + '.lock', 'a')
+    except OSError:
+        serror('Unable to lock rules state: {}'.format(RULES_STATE_LOC))
+        return None
+
+    fcntl.flock(lock_file, fcntl.LOCK_EX)
+    return lock_file
+
+def update_rules_state():
+    """Bring the rules state file up to date with the rule files.
+
+    The state file (~/.config/qubes/always-open-in-dispvm.state) holds:
+
+        <generation> <digest of the rules> <oldest generation with a diff>
+        <stamps of the rule files, see rules_stamps()>
+        =<untrusted folder>            for each current folder
+        *<untrusted phrase>            the current phrase
+        +<generation> <folder>         folder added in that generation
+        -<generation> <folder>         folder removed in that generation
+        ~<generation> <phrase>         phrase set in that generation
+
+    The generation goes up whenever the rules' contents change, and the
+    last RULES_HISTORY_LENGTH generations of changes are kept. The file is
+    replaced atomically, and only one process at a time updates it, see
+    lock_rules_state(). Returns (generation, digest).
+    """
+
+    # Read, compare and replace under the lock, so two processes noticing
+    # the same change don't both start a generation with its own history
+    lock_file = lock_rules_state()
+    try:
+        state = read_rules_state() or {'generation': 0, 'digest': '',
+                'oldest': 0, 'stamps': '', 'folders': set(), 'phrase': '',
+                'history': []}
+
+        stamps = rules_stamps()
+        folders = set(retrieve_untrusted_folders())
+        phrase = retrieve_untrusted_phrase()
+        digest = hashlib.sha256('\n'.join(sorted(folders) + [phrase]).encode(
+                errors='surrogateescape')).hexdigest()
+
+        if digest != state['digest']:
+            state['generation'] += 1
+            state['history'] += \
+                    [(state['generation'], '+', folder)
+                     for folder in sorted(folders - state['folders'])] + \
+                    [(state['generation'], '-', folder)
+                     for folder in sorted(state['folders'] - folders)]
+            if phrase != state['phrase']:
+                state['history'].append((state['generation'], '~', phrase))
+
+            # Forget the oldest changes
+            state['oldest'] = max(state['oldest'],
+                    state['generation'] - RULES_HISTORY_LENGTH)
+            state['history'] = [change for change in state['history']
+                                if change[0] > state['oldest']]
+        elif stamps == state['stamps']:
+            return state['generation'], digest
+
+        lines = ['{} {} {}'.format(state['generation'], digest,
+                                   state['oldest']),
+                 stamps]
+        lines += ['=' + folder for folder in sorted(folders)]
+        lines.append('*' + phrase)
+        lines += ['{}{} {}'.format(change, generation, value)
+                  for generation, change, value in state['history']]
+
+        try:
+            state_dir = os.path.dirname(RULES_STATE_LOC)
+            os.makedirs(state_dir, exist_ok=True)
+            fd, temp_path = tempfile.mkstemp(dir=state_dir, prefix='.state-')
+            try:
+                with os.fdopen(fd, 'w',
+                               errors='surrogateescape') as state_file:
+                    state_file.write('\n'.join(lines) + '\n')
+                os.replace(temp_path, RULES_STATE_LOC)
+            except:
+                os.unlink(temp_path)
+                raise
+        except OSError:
+            serror('Unable to write rules state: {}'.format(RULES_STATE_LOC))
+
+        return state['generation'], digest
+    finally:
+        if lock_file is not None:
+            lock_file.close()
+
+def rules_generation():
+    """Return (generation, digest) of the current rules.
+
+    This only reads the first lines of the state file and stats the rule
+    files, unless they changed since the state was written, e.g. because
+    they were edited by hand.
+    """
+
+    state = read_rules_state(header_only=True)
+    if state is not None and state['stamps'] == rules_stamps():
+        return state['generation'], state['digest']
+
+    return update_rules_state()
+
+def rules_diff_since(generation):
+    """Return (added, removed, phrase) since the given generation, or None
+    if that generation's changes are no longer kept.
+
+    added and removed are sets of untrusted folders. phrase is the untrusted
+    phrase if it was set since, or None.
+    """
+
+    current_generation, _ = rules_generation()
+    state = read_rules_state()
+
+    if state is None or generation > current_generation or \
+       generation < state['oldest']:
+        return None
+
+    added = set()
+    removed = set()
+    phrase = None
+    for change_generation, change, value in state['history']:
+        if change_generation <= generation:
+            continue
+
+        if change == '~':
+            phrase = value
+        elif change == '+':
+            if value in removed:
+                removed.discard(value)
+            else:
+                added.add(value)
+        else:
+            if value in added:
+                added.discard(value)
+            else:
+                removed.add(value)
+
+    return added, removed, phrase
+
+def load_untrusted_rules(refresh=False):
+    """Return the untrusted folders and phrase, reading them on first use.
+
+    Folder paths are made absolute and canonicalized once here, and both
+    forms are kept, so that matching a path is just a set lookup for each of
+    its parent folders. Long-lived callers can pass refresh to reload the
+    rules if their generation has changed.
+    """
+
+    global UNTRUSTED_RULES
+    global UNTRUSTED_RULES_GENERATION
+
+    if refresh and UNTRUSTED_RULES is not None and \
+       rules_generation() != UNTRUSTED_RULES_GENERATION:
+        UNTRUSTED_RULES = None
+
+    if UNTRUSTED_RULES is None:
+        if refresh:
+            UNTRUSTED_RULES_GENERATION = rules_generation()
+        untrusted_folders = set()
+        for folder in retrieve_untrusted_folders():
+            untrusted_folders.add(os.path.abspath(folder))
+            untrusted_folders.add(canonical_path(folder))
+        untrusted_folders = frozenset(untrusted_folders)
+        UNTRUSTED_RULES = (untrusted_folders,
+                retrieve_untrusted_phrase().upper())
+
+    return UNTRUSTED_RULES
+
+def clear_caches():
+    """Forget all cached rules, folder trust and resolved paths"""
+
+    global UNTRUSTED_RULES
+    global UNTRUSTED_RULES_GENERATION
+    global HASH_LISTS
+    global LOCKED_DIGESTS
+
+    UNTRUSTED_RULES = None
+    UNTRUSTED_RULES_GENERATION = None
+    HASH_LISTS = None
+    LOCKED_DIGESTS = None
+    FOLDER_TRUST_CACHE.clear()
+    REALPATH_CACHE.clear()
+    DIGEST_CACHE.clear()
+
+def refresh_caches():
+    """Start a new batch of checks in a long-lived process.
+
+    Folder xattrs and symlinks can change at any time, so what was cached
+    about them is forgotten. Rules and hash lists are only read again if
+    they changed. Digests are kept, they are checked against the file.
+    """
+
+    global LOCKED_DIGESTS
+
+    FOLDER_TRUST_CACHE.clear()
+    REALPATH_CACHE.clear()
+    LOCKED_DIGESTS = None
+    load_untrusted_rules(refresh=True)
+    load_hash_lists(refresh=True)
+
+def retrieve_hashes(*list_locs):
+    """Read SHA-256 digests from the given lists into a set.
+
+    Lines are either a bare digest or sha256sum output. Lists are optional,
+    missing ones are skipped.
+    """
+
+    digests = set()
+
+    for list_loc in list_locs:
+        try:
+            with open(list_loc) as hash_list:
+                for line in hash_list.readlines():
+                    line = line.strip()
+
+                    # Ignore empty lines and comments
+                    if not line or line.startswith('#'):
+                        continue
+
+                    digest = line.split()[0].lower()
+                    if len(digest) == 64:
+                        digests.add(digest)
+        except FileNotFoundError:
+            pass
+        except:
+            serror('Unable to open hash list: {}'.format(list_loc))
+
+    return digests
+
+def load_hash_lists(refresh=False):
+    """Return the sets of trusted and untrusted digests, reading them on
+    first use. Pass refresh to read them again if the lists have changed"""
+
+    global HASH_LISTS
+    global HASH_LISTS_STAMPS
+
+    stamps = file_stamps(GLOBAL_TRUSTED_HASHES_LOC, LOCAL_TRUSTED_HASHES_LOC,
+            GLOBAL_UNTRUSTED_HASHES_LOC, LOCAL_UNTRUSTED_HASHES_LOC) \
+            if refresh or HASH_LISTS is None else HASH_LISTS_STAMPS
+
+    if HASH_LISTS is None or stamps != HASH_LISTS_STAMPS:
+        HASH_LISTS_STAMPS = stamps
+        HASH_LISTS = (
+            frozenset(retrieve_hashes(GLOBAL_TRUSTED_HASHES_LOC,
+                                      LOCAL_TRUSTED_HASHES_LOC)),
+            frozenset(retrieve_hashes(GLOBAL_UNTRUSTED_HASHES_LOC,
+                                      LOCAL_UNTRUSTED_HASHES_LOC)))
+
+    return HASH_LISTS
+
+def hash_file(path):
+    """Return the SHA-256 hex digest of a file's contents.
+
+    The file is mapped into memory rather than read, hashlib releases the
+    GIL while hashing it so several files can be hashed in threads.
+    """
+
+    digest = hashlib.sha256()
+
+    with open(path, 'rb') as hashed_file:
+        try:
+            with mmap.mmap(hashed_file.fileno(), 0,
+                           access=mmap.ACCESS_READ) as contents:
+                digest.update(contents)
+        except ValueError:
+            # Empty files can't be mapped
+            pass
+        except OSError:
+            # Neither can files on some filesystems
+            for block in iter(lambda: hashed_file.read(1 << 20), b''):
+                digest.update(block)
+
+    return digest.hexdigest()
+
+def locked_digest_key(file_stat):
+    """Return what identifies a version of a file in the digest index"""
+
+    return (file_stat.st_dev, file_stat.st_ino, file_stat.st_size,
+            file_stat.st_mtime_ns, file_stat.st_ctime_ns)
+
+def locked_digest(file_stat):
+    """Return the digest save_locked_digest() kept for a file, or None"""
+
+    global LOCKED_DIGESTS
+
+    if LOCKED_DIGESTS is None:
+        LOCKED_DIGESTS = {}
+        try:
+            with open(DIGEST_INDEX_LOC) as index:
+                for line in index:
+                    fields = line.split()
+                    if len(fields) != 6 or len(fields[5]) != 64:
+                        continue
+                    try:
+                        key = tuple(int(field) for field in fields[:5])
+                    except ValueError:
+                        continue
+                    LOCKED_DIGESTS[key] = fields[5]
+        except FileNotFoundError:
+            pass
+        except OSError:
+            serror('Unable to read digest index: {}'.format(DIGEST_INDEX_LOC))
+
+    return LOCKED_DIGESTS.get(locked_digest_key(file_stat))
+
+def compact_digest_index():
+    """Rewrite the digest index with only the newest entry for each file,
+    dropping the oldest files until it is half of DIGEST_INDEX_MAX_SIZE"""
+
+    with open(DIGEST_INDEX_LOC) as index:
+        lines = index.readlines()
+
+    newest = collections.OrderedDict()
+    for line in lines:
+        fields = line.split()
+        if len(fields) == 6:
+            newest.pop(tuple(fields[:2]), None)
+            newest[tuple(fields[:2])] = line
+
+    kept = []
+    size = 0
+    for line in reversed(newest.values()):
+        size += len(line)
+        if size > DIGEST_INDEX_MAX_SIZE // 2:
+            break
+        kept.append(line)
+
+    fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(DIGEST_INDEX_LOC),
+                                     prefix='.digests-')
+    try:
+        with os.fdopen(fd, 'w') as index:
+            index.writelines(reversed(kept))
+        os.replace(temp_path, DIGEST_INDEX_LOC)
+    except:
+        os.unlink(temp_path)
+        raise
+
+def save_locked_digest(path, digest):
+    """Remember the digest of a file that has just been locked.
+
+    Locked files can't be read, and neither can their xattrs, so the digest
+    is kept in ~/.config/qubes/qubes-trust-digests instead. Entries are
+    keyed by the file's inode, size, mtime and ctime, so any change to the
+    file, including unlocking it, leaves its entry behind.
+    """
+
+    try:
+        key = locked_digest_key(os.stat(path))
+        os.makedirs(os.path.dirname(DIGEST_INDEX_LOC), exist_ok=True)
+        with open(DIGEST_INDEX_LOC, 'a') as index:
+            index.write('{} {} {} {} {} {}\n'.format(*key + (digest,)))
+            index_size = index.tell()
+
+        if LOCKED_DIGESTS is not None:
+            LOCKED_DIGESTS[key] = digest
+        if index_size > DIGEST_INDEX_MAX_SIZE:
+            compact_digest_index()
+    except OSError:
+        serror('Unable to save digest of {} in: {}'.format(path,
+                DIGEST_INDEX_LOC))
+
+def file_digest(path):
+    """Return the SHA-256 hex digest of a regular file, or None.
+
+    Digests are cached in DIGEST_CACHE and in the 'user.qubes.sha256' xattr
+    along with the file's inode, mtime and size, so a file is only hashed
+    again after it changes. Locked files are looked up in the digest index,
+    see save_locked_digest().
+    """
+
+    try:
+        file_stat = os.stat(path)
+        if not stat.S_ISREG(file_stat.st_mode):
+            return None
+
+        key = (file_stat.st_dev, file_stat.st_ino, file_stat.st_mtime_ns,
+               file_stat.st_size)
+        if key in DIGEST_CACHE:
+            return DIGEST_CACHE[key]
+
+        stamp = '{} {} {}'.format(file_stat.st_ino, file_stat.st_mtime_ns,
+                                  file_stat.st_size)
+        try:
+            cached_stamp, _, digest = xattr.get(path,
+                    'user.qubes.sha256').decode().rpartition(' ')
+            if cached_stamp == stamp:
+                DIGEST_CACHE[key] = digest
+                return digest
+        except (IOError, OSError, UnicodeDecodeError):
+            pass
+
+        try:
+            digest = hash_file(path)
+        except PermissionError:
+            return locked_digest(file_stat)
+
+        # Don't cache anything if the file changed while we were hashing it
+        new_stat = os.stat(path)
+        if (new_stat.st_ino, new_stat.st_mtime_ns, new_stat.st_size) != \
+           (file_stat.st_ino, file_stat.st_mtime_ns, file_stat.st_size):
+            return digest
+    except (IOError, OSError):
+        return None
+
+    DIGEST_CACHE[key] = digest
+    try:
+        xattr.setxattr(path, 'user.qubes.sha256',
+                       '{} {}'.format(stamp, digest).encode())
+    except (IOError, OSError):
+        # Read-only file or filesystem, keep it for this process only
+        pass
+
+    return digest
+
+def hash_files(paths):
+    """Return a dict of path -> digest for many files.
+
+    Large batches are hashed in a thread pool. Results are also stored in
+    the digest cache, so later checks of the same files don't hash them.
+    """
+
+    if len(paths) < HASH_PARALLEL_MIN or HASH_JOBS < 2:
+        return {path: file_digest(path) for path in paths}
+
+    with concurrent.futures.ThreadPoolExecutor(HASH_JOBS) as pool:
+        return dict(zip(paths, pool.map(file_digest, paths)))
+
+def is_untrusted_hash(path):
+    """Check a file's contents against the trusted and untrusted digests.
+
+    Returns True if the file is in the untrusted list, False if it is in the
+    trusted list, and None if neither list decides (including when the file
+    can't be read).
+    """
+
+    trusted_hashes, untrusted_hashes = load_hash_lists()
+    if not (trusted_hashes or untrusted_hashes):
+        return None
+
+    digest = file_digest(path)
+    if digest is None:
+        return None
+
+    if digest in untrusted_hashes:
+        return True
+    if digest in trusted_hashes:
+        return False
+
+    return None
+
 def print_folders():
     """Print all known untrusted folders, line-by-line."""
 
+    # Record any hand edits, so qubes-trust-daemon sees a new generation
+    rules_generation()
+
     untrusted_folders = retrieve_untrusted_folders()
 
     # Print out all untrusted folders line-by-line
@@ -141,30 +778,232 @@ def safe_chmod(path, perms, msg):
         error(msg)
         sys.exit(77)
 
-def is_untrusted_xattr(path, orig_perms):
-    """Check for 'user.qubes.untrusted' xattr on the file.
+def pack_trust_record(record):
+    """Pack a TrustRecord into the value of a 'user.qubes.untrusted' xattr"""
+
+    origin = os.fsencode(record.origin)[:0xff]
+    rule = os.fsencode(record.rule)[:0xffff]
 
-    Expects a readable file.
+    flags = TRUST_RECORD_UNTRUSTED if record.untrusted else 0
+    if record.mode is not None:
+        flags |= TRUST_RECORD_HAS_MODE
+
+    return TRUST_RECORD_HEADER.pack(TRUST_RECORD_VERSION, flags,
+            record.mode or 0, record.timestamp, len(origin),
+            len(rule)) + origin + rule
+
+def parse_trust_record(value):
+    """Unpack the value of a 'user.qubes.untrusted' xattr into a TrustRecord.
+
+    Anything we can't make sense of, such as a record from a newer version,
+    is treated as untrusted.
     """
 
+    if value in (b'true', b'false'):
+        return TrustRecord(value == b'true', '', 0, '', None)
+
     try:
-        file_xattrs = xattr.get_all(path)
+        version, flags, mode, timestamp, origin_len, rule_len = \
+                TRUST_RECORD_HEADER.unpack_from(value)
+    except struct.error:
+        return TrustRecord(True, '', 0, '', None)
 
-    except:
-        error('Unable to read extended attributes of {}'.format(path))
-        sys.exit(65)
+    strings = value[TRUST_RECORD_HEADER.size:]
+    if version != TRUST_RECORD_VERSION or \
+       len(strings) != origin_len + rule_len:
+        return TrustRecord(True, '', 0, '', None)
+
+    return TrustRecord(bool(flags & TRUST_RECORD_UNTRUSTED),
+                       os.fsdecode(strings[:origin_len]), timestamp,
+                       os.fsdecode(strings[origin_len:]),
+                       mode if flags & TRUST_RECORD_HAS_MODE else None)
+
+def read_trust_record(path):
+    """Return the TrustRecord of a path, or None if it doesn't have one.
+
+    Raises OSError if the attribute can't be read.
+    """
+
+    try:
+        return parse_trust_record(xattr.get(path, 'user.qubes.untrusted'))
+    except (IOError, OSError) as err:
+        if err.errno in (errno.ENODATA, errno.ENOTSUP):
+            return None
+        raise
+
+def origin_vm(path):
+    """Return the qube a file came from if it's in ~/QubesIncoming, or ''"""
+
+    relative = os.path.relpath(canonical_path(path),
+                               canonical_path(QUBES_INCOMING_LOC))
+    parts = relative.split(os.sep)
+
+    if len(parts) < 2 or parts[0] == os.pardir:
+        return ''
+
+    return parts[0]
+
+def default_file_mode():
+    """Return the permissions a new file would get under the current umask"""
+
+    umask = os.umask(0)
+    os.umask(umask)
+
+    return 0o666 & ~umask
+
+def folder_xattr_trust(path):
+    """Read the 'user.qubes.untrusted' marker of a folder.
+
+    Returns True if the folder is marked untrusted, False if it is
+    explicitly marked trusted and None if it carries no marker.
+    """
+
+    try:
+        record = read_trust_record(path)
+    except (IOError, OSError):
+        return None
+
+    return None if record is None else record.untrusted
+
+def is_untrusted_folder_xattr(path):
+    """Check whether a folder is untrusted through its own xattr, or that of
+    the nearest ancestor carrying one.
+
+    Results are cached per folder, so checking many files in the same tree
+    only walks up it once.
+    """
+
+    walked = []
+    untrusted = False
+    while True:
+        if path in FOLDER_TRUST_CACHE:
+            untrusted = FOLDER_TRUST_CACHE[path]
+            break
+
+        walked.append(path)
+        marker = folder_xattr_trust(path)
+        if marker is not None:
+            untrusted = marker
+            break
+
+        parent = os.path.dirname(path)
+        if parent == path:
+            break
+        path = parent
+
+    # Everything we passed through inherits from the same place
+    if len(FOLDER_TRUST_CACHE) + len(walked) > FOLDER_CACHE_SIZE:
+        FOLDER_TRUST_CACHE.clear()
+    for folder in walked:
+        FOLDER_TRUST_CACHE[folder] = untrusted
+
+    return untrusted
+
+def forget_folder_trust(path):
+    """Drop cached folder trust for a folder and everything beneath it"""
+
+    prefix = path.rstrip('/') + '/'
+    for folder in list(FOLDER_TRUST_CACHE):
+        if folder == path or folder.startswith(prefix):
+            del FOLDER_TRUST_CACHE[folder]
+
+def query_daemon(query, whole_reply=False):
+    """Send a query to qubes-trust-daemon and return its reply line, or its
+    whole reply.
+
+    Returns None if the daemon isn't running. Once it is, a reply that
+    doesn't arrive within DAEMON_TIMEOUT comes back as b''.
+    """
+
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.settimeout(DAEMON_TIMEOUT)
+        try:
+            sock.connect(DAEMON_SOCKET_LOC)
+        except (socket.timeout, BlockingIOError):
+            # Running, but too busy to take the query
+            return b''
+        except OSError:
+            return None
+
+        try:
+            sock.sendall(query + b'\n')
+            with sock.makefile('rb') as reply_file:
+                if whole_reply:
+                    return reply_file.read()
+                return reply_file.readline()
+        except OSError:
+            return b''
+
+def daemon_watched_path(path):
+    """Return the form of a path qubes-trust-daemon would know it by, or None
+    if it isn't in an untrusted folder, which is all the daemon watches"""
+
+    untrusted_folders, _ = load_untrusted_rules()
+
+    for watched_path in (os.path.abspath(path), canonical_path(path)):
+        if matching_untrusted_folder(watched_path,
+                                     untrusted_folders) is not None:
+            return watched_path
+
+    return None
+
+def is_pending_untrusted(path):
+    """Ask qubes-trust-daemon whether a file is queued to be marked untrusted.
+
+    The daemon marks queued files in batches, so a new file in an untrusted
+    folder can be checked before it has its xattr. If the path is queued,
+    the daemon marks it ahead of the rest and we treat it as untrusted. So
+    does a daemon that is running but doesn't answer, as it may be holding
+    the file. Returns False if the daemon isn't running or doesn't know the
+    path. Paths outside untrusted folders aren't asked about.
+    """
+
+    path = daemon_watched_path(path)
+    if path is None:
+        return False
+
+    reply = query_daemon(os.fsencode(path))
+    if reply is None:
+        return False
+
+    return reply != b'UNKNOWN\n'
+
+def pending_untrusted_names(*folders):
+    """Ask qubes-trust-daemon which files directly inside a folder are
+    queued to be marked untrusted, with a single query per folder.
+
+    The daemon marks them ahead of the rest, as with is_pending_untrusted().
+    It knows files by the path it found them under, so pass each form of
+    the folder that path might take. Forms outside untrusted folders aren't
+    asked about. Returns a set of names, empty if the daemon isn't running,
+    or None if it is running but doesn't answer, in which case any file in
+    the folder may be queued.
+    """
 
-    # Check for our custom qubes attribute
-    untrusted_attribute = (b'user.qubes.untrusted', b'true')
+    untrusted_folders, _ = load_untrusted_rules()
 
-    # Return whether we found our attribute
-    return (untrusted_attribute in file_xattrs)
+    names = set()
+    for folder in set(folders):
+        if matching_untrusted_folder(folder, untrusted_folders) is None:
+            continue
+
+        reply = query_daemon(b'LIST ' + os.fsencode(folder), True)
+        if reply is None:
+            continue
+
+        # Each name ends in a NUL, and the whole reply in a newline
+        if not reply.endswith(b'\n'):
+            return None
+        names.update(os.fsdecode(name)
+                     for name in reply[:-1].split(b'\0') if name)
+
+    return names
 
 def set_visual_attributes_on(path):
     """Add visual attributes to a path, such as emblems"""
     # Set specified visual attributes
     try:
-        subprocess.Popen(['/usr/bin/gvfs-set-attribute', os.path.realpath(path), '-t', 'stringv',
+        subprocess.Popen(['/usr/bin/gvfs-set-attribute', canonical_path(path), '-t', 'stringv',
             'metadata::emblems', 'important'])
         os.utime(path, None)
     except:
@@ -174,44 +1013,61 @@ def set_visual_attributes_off(path):
     """Remove visual attributes from a path, such as emblems"""
     # Remove specified visual attributes
     try:
-        proc = subprocess.Popen(['/usr/bin/gvfs-set-attribute', os.path.realpath(path), '-t', 'unset',
+        proc = subprocess.Popen(['/usr/bin/gvfs-set-attribute', canonical_path(path), '-t', 'unset',
             'metadata::emblems'], stdout=subprocess.PIPE)
         os.utime(path, None)
     except:
         error('Error removing visual attributes of path: {}'.format(path))
 
-def path_is_parent(parent, child):
-    """Check if a child file/path is in a parent folder/path."""
+def matching_untrusted_folder(path, untrusted_folders):
+    """Return the untrusted folder that an absolute, normalized path lies
+    in, or None"""
 
-    parent = os.path.abspath(parent)
-    child = os.path.abspath(child)
+    while True:
+        if path in untrusted_folders:
+            return path
 
-    return os.path.commonpath([parent]) == os.path.commonpath([parent, child])
+        parent = os.path.dirname(path)
+        if parent == path:
+            return None
+        path = parent
 
-def is_untrusted_path(path):
+def untrusted_path_source(path, real_path=None):
     """Check to see if the path lies under a path that's considered untrusted
 
     Files listing untrusted paths lie in /etc/qubes/ and ~/.config/qubes
-    under the name always-open-in-dispvm.list
+    under the name always-open-in-dispvm.list. Symlinks are resolved, pass
+    real_path if the caller already has the canonical path.
+
+    Returns 'folder-rule' or 'phrase' depending on what matched, or None.
     """
 
-    untrusted_paths = retrieve_untrusted_folders()
+    untrusted_folders, untrusted_phrase = load_untrusted_rules()
+
+    if real_path is None:
+        real_path = canonical_path(path)
+    abs_path = os.path.abspath(path)
 
-    # Checks if the path is a child of an untrusted path (might be Linux only)
-    for untrusted_path in untrusted_paths:
-        if path_is_parent(untrusted_path, path):
-            return True
+    # Checks if the path is a child of an untrusted path (might be Linux only),
+    # either as given or once symlinks are resolved
+    if matching_untrusted_folder(real_path, untrusted_folders) is not None or \
+       (abs_path != real_path and
+        matching_untrusted_folder(abs_path, untrusted_folders) is not None):
+        return 'folder-rule'
 
     # Check if untrusted phrase (/etc/qubes/always-open-in-dispvm.phrase) is
     # present in file path
-    global UNTRUSTED_PHRASE
+    if untrusted_phrase and (untrusted_phrase in path.upper() or
+                             untrusted_phrase in real_path.upper()):
+        return 'phrase'
 
-    # Check if string is empty
-    if not UNTRUSTED_PHRASE:
-        return False
+    return None
+
+def is_untrusted_path(path, real_path=None):
+    """Check to see if the path lies under a path that's considered untrusted,
+    or contains the untrusted phrase"""
 
-    # Otherwise check if path contains untrusted phrase
-    return UNTRUSTED_PHRASE.upper() in path.upper()
+    return untrusted_path_source(path, real_path) is not None
 
 def handle_trust(path, multiple_paths, object_type, untrusted):
     """Common code for when a file or folder is found trusted or untrusted"""
@@ -233,14 +1089,25 @@ def handle_trust(path, multiple_paths, object_type, untrusted):
                                  ), False)
         sys.exit((1 if untrusted else 0))
 
-def check_file(path, multiple_paths):
-    """Check the given file's trust. Returns True if untrusted"""
+def file_verdict(path):
+    """Check the given file's trust.
 
-    global UNTRUSTED_PATH_FOUND
-    global ALL_PATHS_ARE_UNTRUSTED
+    Returns (untrusted, source), where source names the check that decided
+    or is None if nothing marked the file untrusted. Raises OSError if the
+    file or its attributes can't be read.
+    """
 
-    # Save the original permissions of the file.
-    orig_perms = os.stat(path).st_mode
+    # Make sure the file exists
+    os.stat(path)
+
+    # Known bad contents decide, whichever folder the file is in
+    untrusted_hash = is_untrusted_hash(path)
+    if untrusted_hash:
+        return True, 'hash'
+
+    # Files still queued in qubes-trust-daemon don't have their xattr yet
+    if is_pending_untrusted(path):
+        return True, 'daemon'
 
     # See if the file is readable
     try:
@@ -249,32 +1116,246 @@ def check_file(path, multiple_paths):
 
     except IOError:
         # If file is not readable, assume untrusted
-        handle_trust(path, multiple_paths, "File", True)
+        return True, 'unreadable'
 
     # File is readable, attempt to check trusted status
-    if is_untrusted_xattr(path, orig_perms) or is_untrusted_path(path):
-        # Print out which paths are untrusted if we're checking multiple paths
-        handle_trust(path, multiple_paths, "File", True)
-    else:
-        # Don't return until we've checked all paths
-        handle_trust(path, multiple_paths, "File", False)
+    record = read_trust_record(path)
+    if record is not None and record.untrusted:
+        return True, 'xattr'
 
-def check_folder(path, multiple_paths):
-    """Check if the given folder is trusted"""
+    # Known good contents are trusted whichever folder the file is in, but
+    # don't override the file's own marking
+    if untrusted_hash is False:
+        return False, 'hash'
+
+    real_path = canonical_path(path)
+    if is_untrusted_folder_xattr(os.path.dirname(real_path)):
+        return True, 'folder-xattr'
+
+    source = untrusted_path_source(path, real_path)
+    return source is not None, source
+
+def folder_verdict(path):
+    """Check the given folder's trust. Returns (untrusted, source)"""
 
     # Remove '/' from end of path
     path = os.path.normpath(path)
 
-    # Check if path is in the untrusted paths list
-    if is_untrusted_path(path):
-        # Print out which paths are untrusted if we're checking multiple paths
-        handle_trust(path, multiple_paths, "Folder", True)
+    # Check if path is in the untrusted paths list, or inherits an xattr
+    real_path = canonical_path(path)
+    source = untrusted_path_source(path, real_path)
+    if source is not None:
+        return True, source
+
+    if is_untrusted_folder_xattr(real_path):
+        return True, 'folder-xattr'
+
+    return False, None
+
+def is_untrusted_file(path):
+    """Check the given file's trust. Returns True if untrusted"""
+
+    return file_verdict(path)[0]
+
+def evaluate_path(path):
+    """Check a file or folder's trust without printing or exiting.
+
+    Returns a TrustVerdict.
+    """
+
+    try:
+        if os.path.isdir(path):
+            untrusted, source = folder_verdict(path)
+        else:
+            untrusted, source = file_verdict(path)
+    except (IOError, OSError) as err:
+        return TrustVerdict(path, None, None, err.strerror or str(err))
+
+    return TrustVerdict(path, untrusted, source, None)
+
+def check_file(path, multiple_paths):
+    """Check the given file's trust and report it"""
+
+    try:
+        untrusted, _ = file_verdict(path)
+    except (IOError, OSError) as err:
+        error('Unable to check {}: {}'.format(path, err.strerror or err))
+        sys.exit(65)
+
+    handle_trust(path, multiple_paths, "File", untrusted)
+
+def check_folder(path, multiple_paths):
+    """Check if the given folder is trusted"""
+
+    untrusted, _ = folder_verdict(path)
+
+    # Print out which paths are untrusted if we're checking multiple paths
+    handle_trust(os.path.normpath(path), multiple_paths, "Folder", untrusted)
+
+def check_directory(path):
+    """Check the trust of every entry in a folder. Returns a list of
+    TrustVerdicts, sorted by name.
+
+    This gives the same verdicts as calling evaluate_path on each entry,
+    but the folder is only listed once, and its rules, phrase, inherited
+    xattrs and files queued in qubes-trust-daemon are only checked once.
+    Each entry then just needs its own xattr read, relative to the open
+    folder. Raises OSError if the folder can't be listed.
+    """
+
+    path = os.path.abspath(path)
+    real_dir = canonical_path(path)
+    untrusted_folders, untrusted_phrase = load_untrusted_rules()
+
+    # Whatever the folder inherits applies to everything in it
+    in_untrusted_folder = \
+            matching_untrusted_folder(real_dir, untrusted_folders) is not None \
+            or matching_untrusted_folder(path, untrusted_folders) is not None
+    inherits_xattr = is_untrusted_folder_xattr(real_dir)
+    check_hashes = any(load_hash_lists())
+    pending = pending_untrusted_names(path, real_dir)
+
+    verdicts = []
+    dir_fd = os.open(real_dir, os.O_RDONLY | os.O_DIRECTORY)
+    try:
+        # Look entries up relative to the folder we already have open
+        if os.path.isdir('/proc/self/fd'):
+            fd_path = '/proc/self/fd/{}'.format(dir_fd)
+        else:
+            fd_path = real_dir
+
+        with os.scandir(real_dir) as entries:
+            entries = sorted(entries, key=lambda entry: entry.name)
+
+        for entry in entries:
+            entry_path = os.path.join(path, entry.name)
+            real_path = os.path.join(real_dir, entry.name)
+
+            try:
+                # Symlinks lead out of this folder, check them in full
+                if entry.is_symlink():
+                    verdicts.append(evaluate_path(entry_path))
+                    continue
+
+                is_dir = entry.is_dir()
+                untrusted, source = False, None
+                untrusted_hash = None
+
+                if not is_dir:
+                    if check_hashes:
+                        untrusted_hash = is_untrusted_hash(real_path)
+
+                    if untrusted_hash:
+                        untrusted, source = True, 'hash'
+                    elif pending is None or entry.name in pending:
+                        untrusted, source = True, 'daemon'
+                    elif not os.access(entry.name, os.R_OK, dir_fd=dir_fd):
+                        untrusted, source = True, 'unreadable'
+
+                if not untrusted:
+                    entry_fd_path = os.path.join(fd_path, entry.name)
+
+                    # Folders with their own marker don't inherit one. One
+                    # that can't be read counts as no marker, as it does
+                    # when the folder is checked alone
+                    if is_dir:
+                        marker = folder_xattr_trust(entry_fd_path)
+                        entry_xattr = inherits_xattr if marker is None \
+                                      else marker
+                    else:
+                        record = read_trust_record(entry_fd_path)
+                        if record is not None and record.untrusted:
+                            untrusted, source = True, 'xattr'
+                        else:
+                            entry_xattr = inherits_xattr
+
+                    if untrusted:
+                        pass
+                    elif untrusted_hash is False:
+                        source = 'hash'
+                    elif entry_xattr and not is_dir:
+                        untrusted, source = True, 'folder-xattr'
+                    elif in_untrusted_folder or \
+                         real_path in untrusted_folders or \
+                         entry_path in untrusted_folders:
+                        untrusted, source = True, 'folder-rule'
+                    elif untrusted_phrase and \
+                         (untrusted_phrase in entry_path.upper() or
+                          untrusted_phrase in real_path.upper()):
+                        untrusted, source = True, 'phrase'
+                    elif entry_xattr:
+                        untrusted, source = True, 'folder-xattr'
+            except (IOError, OSError) as err:
+                verdicts.append(TrustVerdict(entry_path, None, None,
+                                             err.strerror or str(err)))
+                continue
+
+            verdicts.append(TrustVerdict(entry_path, untrusted, source, None))
+    finally:
+        os.close(dir_fd)
+
+    return verdicts
+
+def format_verdict(verdict, output_format):
+    """Format a TrustVerdict as bytes for the given --format"""
+
+    if verdict.untrusted is None:
+        state = 'error'
     else:
-        # Don't return until we've checked all paths
-        handle_trust(path, multiple_paths, "Folder", False)
+        state = 'untrusted' if verdict.untrusted else 'trusted'
+
+    if output_format == 'text':
+        if verdict.error:
+            return '{}: Error: {}\n'.format(verdict.path,
+                    verdict.error).encode(errors='surrogateescape')
+        return '{}: {}\n'.format(verdict.path, state.capitalize()).encode(
+                errors='surrogateescape')
+
+    if output_format == 'jsonl':
+        return json.dumps({'path': verdict.path, 'verdict': state,
+                           'source': verdict.source, 'error': verdict.error}
+                          ).encode() + b'\n'
+
+    # Four NUL terminated fields per path, empty if not set
+    return b''.join(os.fsencode(field or '') + b'\0' for field in
+            (verdict.path, state, verdict.source, verdict.error))
+
+def write_verdicts(verdicts, output_format):
+    """Stream TrustVerdicts to stdout in the given format, a chunk at a time.
+
+    Returns (whether any path was untrusted, whether all paths were).
+    Paths that couldn't be checked count as untrusted.
+    """
+
+    untrusted_found = False
+    all_untrusted = True
+    chunk = []
+
+    for verdict in verdicts:
+        if verdict.untrusted is False:
+            all_untrusted = False
+        else:
+            untrusted_found = True
 
-def change_file(path, trusted):
-    """Change the trust state of a file"""
+        if not OUTPUT_QUIET:
+            chunk.append(format_verdict(verdict, output_format))
+            if len(chunk) >= OUTPUT_CHUNK_SIZE:
+                sys.stdout.buffer.write(b''.join(chunk))
+                sys.stdout.buffer.flush()
+                chunk = []
+
+    if chunk:
+        sys.stdout.buffer.write(b''.join(chunk))
+        sys.stdout.buffer.flush()
+
+    return untrusted_found, all_untrusted
+
+def change_file(path, trusted, rule=None):
+    """Change the trust state of a file.
+
+    When marking a file untrusted, rule is recorded as the reason. It
+    defaults to the untrusted folder the file is in, if any.
+    """
 
     # Save the original permissions of the file
     orig_perms = os.stat(path).st_mode
@@ -288,33 +1369,74 @@ def change_file(path, trusted):
         # Try to unlock file to get read/write access
         safe_chmod(path, 0o600,
             'Could not unlock {} for reading'.format(path))
+
+    try:
+        record = read_trust_record(path)
+    except:
+        error('Unable to read extended attributes of {}'.format(path))
+        safe_chmod(path, orig_perms,
+            'Unable to set original perms. on {}'.format(path))
+        sys.exit(65)
+
     if trusted:
         # Set file to trusted
         # AKA remove our xattr
-        file_xattrs = xattr.get_all(path)
-        untrusted_attribute = (b'user.qubes.untrusted', b'true')
 
         # Check if the xattr exists first
-        if untrusted_attribute in file_xattrs:
+        if record is not None:
             try:
                 xattr.removexattr(path, 'user.qubes.untrusted')
             except:
                 # Unable to remove our xattr, return original permissions
+                # and leave the file locked
                 error('Unable to remove untrusted attribute on {}'.format(path))
                 safe_chmod(path, orig_perms,
                     'Unable to set original perms. on {}'.format(path))
+                sys.exit(65)
+
+        # Finally give back the permissions the file had before it was
+        # locked. Files locked before we kept those get default permissions
+        if record is not None and record.mode is not None:
+            trusted_perms = record.mode
+        elif stat.S_IMODE(orig_perms) == 0:
+            trusted_perms = default_file_mode()
+        else:
+            trusted_perms = stat.S_IMODE(orig_perms)
 
-        # Finally set to restricted permissions
-        safe_chmod(path, 0o200,
-           'Could not set restricted perms. for: {}'.format(path))
+        safe_chmod(path, trusted_perms,
+           'Could not set original perms. for: {}'.format(path))
 
     else:
         # Set file to untrusted
         # AKA add our xattr and lock
+
+        # Keep what we saved when the file was first locked, it's mode 0 now
+        if record is not None and record.untrusted and \
+           record.mode is not None:
+            saved_perms = record.mode
+        elif stat.S_IMODE(orig_perms) != 0:
+            saved_perms = stat.S_IMODE(orig_perms)
+        else:
+            saved_perms = None
+
+        if rule is None:
+            untrusted_folders, _ = load_untrusted_rules()
+            rule = matching_untrusted_folder(canonical_path(path),
+                                             untrusted_folders) or \
+                   matching_untrusted_folder(os.path.abspath(path),
+                                             untrusted_folders) or ''
+
         try:
             safe_chmod(path, 0o600,
                 'Could not unlock {} for writing'.format(path))
-            xattr.setxattr(path, 'user.qubes.untrusted', 'true')
+
+            # Hash it while we still can, so the hash lists apply once it's
+            # locked. Without any lists, don't hold up the locking
+            digest = file_digest(path) if any(load_hash_lists()) else None
+
+            xattr.setxattr(path, 'user.qubes.untrusted',
+                    pack_trust_record(TrustRecord(True, origin_vm(path),
+                        int(time.time()), rule, saved_perms)))
             safe_chmod(path, 0o0,
                     'Unable to set untrusted permissions on: {}'.format(path))
         except:
@@ -324,6 +1446,41 @@ def change_file(path, trusted):
                 format(path))
             sys.exit(65)
 
+        if digest is not None:
+            save_locked_digest(path, digest)
+
+def change_folder_xattr(path, trusted):
+    """Change the trust state of a folder through its xattr.
+
+    Everything beneath the folder inherits the new state, until a folder
+    with its own marker is reached.
+    """
+
+    # Remove '/' from end of path
+    path = os.path.normpath(path)
+
+    try:
+        if trusted:
+            # Remove our own untrusted marker, then stop inheriting one from
+            # further up if there is one
+            if folder_xattr_trust(path) is not None:
+                xattr.removexattr(path, 'user.qubes.untrusted')
+            forget_folder_trust(path)
+
+            if is_untrusted_folder_xattr(os.path.dirname(path)):
+                xattr.setxattr(path, 'user.qubes.untrusted',
+                        pack_trust_record(TrustRecord(False, '',
+                            int(time.time()), '', None)))
+        else:
+            xattr.setxattr(path, 'user.qubes.untrusted',
+                    pack_trust_record(TrustRecord(True, origin_vm(path),
+                        int(time.time()), '', None)))
+    except (IOError, OSError):
+        error('Unable to set trust attribute on folder: {}'.format(path))
+        sys.exit(65)
+    finally:
+        forget_folder_trust(path)
+
 def change_folder(path, trusted):
     """Change the trust state of a folder"""
 
@@ -421,6 +1578,70 @@ def change_folder(path, trusted):
         with open(LOCAL_FOLDER_LOC, 'a') as local_rules:
             local_rules.write(path + '\n')
 
+    # Start a new rules generation, and pick up the changed rules on the
+    # next check
+    rules_generation()
+
+    global UNTRUSTED_RULES
+    UNTRUSTED_RULES = None
+
+def open_in_dispvm(path):
+    """Open an untrusted file in a disposableVM. Returns True on success.
+
+    The file is only unlocked while qvm-open-in-vm runs, and its original
+    permissions are put back whether or not that succeeds.
+    """
+
+    try:
+        untrusted = is_untrusted_file(path)
+    except (IOError, OSError) as err:
+        error('Unable to check {}: {}'.format(path, err.strerror or err))
+        return False
+
+    if not untrusted:
+        qprint('This file is not untrusted. Please first mark it as such '
+               'with qvm-file-trust: {}'.format(path), False)
+        return True
+
+    # Attempt to 'unlock' file for read permissions
+    orig_perms = stat.S_IMODE(os.stat(path).st_mode)
+    try:
+        os.chmod(path, 0o600)
+    except OSError:
+        error('Could not unlock {} for reading'.format(path))
+        return False
+
+    opened = False
+    try:
+        opened = subprocess.call([QVM_OPEN_IN_VM_LOC, '$dispvm', path]) == 0
+        if not opened:
+            error('Unable to open {} in a disposableVM'.format(path))
+    except OSError:
+        error('Unable to run {}'.format(QVM_OPEN_IN_VM_LOC))
+    finally:
+        # Lock the file again
+        try:
+            os.chmod(path, orig_perms)
+        except OSError:
+            error('Unable to set original perms. on {}'.format(path))
+            opened = False
+
+    return opened
+
+def open_many_in_dispvm(paths):
+    """Open untrusted files in disposableVMs, a few at a time.
+
+    Returns True if every file was handled successfully.
+    """
+
+    # Opening the same file twice at once would save the unlocked
+    # permissions as the original ones
+    paths = list(dict.fromkeys(paths))
+
+    workers = max(1, min(OPEN_IN_DISPVM_JOBS, len(paths)))
+    with concurrent.futures.ThreadPoolExecutor(workers) as pool:
+        return all(list(pool.map(open_in_dispvm, paths)))
+
 def main():
     """Read in from the command line and call dependent functions"""
 
@@ -442,11 +1663,29 @@ def main():
                         help='Set files or folders as untrusted')
     parser.add_argument('-p', '--printfolders', action='store_true',
                         help='Print all local folders considered untrusted')
+    parser.add_argument('--rules-generation', action='store_true',
+                        help='Print the generation number and digest of '
+                        'the current untrusted folder rules')
     parser.add_argument('-q', '--quiet', action='store_true',
                         help='Do not print to stdout')
+    parser.add_argument('-o', '--open-in-dispvm', action='store_true',
+                        help='Open untrusted files in disposableVMs')
+    parser.add_argument('-f', '--format', choices=['text', 'jsonl', 'nul'],
+                        default='text',
+                        help='output format for checks. jsonl prints a JSON '
+                        'object per path, nul prints path, verdict, source and '
+                        'error as NUL terminated fields')
+    parser.add_argument('-d', '--check-dir', action='store_true',
+                        help='check trust of everything in the given '
+                        'folders. Returns 1 if at least one entry is '
+                        'untrusted, or with -D, if all of them are')
+    parser.add_argument('-x', '--folder-xattr', action='store_true',
+                        help='Set folder trust with an extended attribute '
+                        'inherited by its contents, instead of the local list')
 
     # Only require a path for certain options
-    if not '--printfolders' in sys.argv and not '-p' in sys.argv:
+    if not '--printfolders' in sys.argv and not '-p' in sys.argv and \
+       not '--rules-generation' in sys.argv:
         parser.add_argument('paths', metavar='path',
                             type=str, nargs='+', help='a folder or file path')
 
@@ -456,22 +1695,6 @@ def main():
     global OUTPUT_QUIET
     OUTPUT_QUIET = args.quiet
 
-    # Grab and cache untrusted phrase
-    global UNTRUSTED_PHRASE
-    try:
-        with open(PHRASE_FILE_LOC) as phrase_file:
-            for line in phrase_file.readlines():
-                line = line.rstrip()
-
-                # Ignore comments
-                if not line.startswith('#'):
-                    UNTRUSTED_PHRASE = line
-                    break
-
-    except:
-        serror('Unable to open phrase file: {}'.
-                format(PHRASE_FILE_LOC))
-
     # Error checking
     if args.trusted and args.untrusted:
         error('--trusted and --untrusted options cannot both be set')
@@ -485,13 +1708,69 @@ def main():
               'options cannot both be set')
         sys.exit(64)
 
+    if args.open_in_dispvm and (args.check or args.trusted or
+            args.untrusted or args.check_multiple or
+            args.check_multiple_all_untrusted):
+        error('--open-in-dispvm cannot be combined with other actions')
+        sys.exit(64)
+
+    if args.check_dir and (args.trusted or args.untrusted or
+            args.open_in_dispvm):
+        error('--check-dir cannot be combined with --trusted, --untrusted '
+              'or --open-in-dispvm')
+        sys.exit(64)
+
+    if args.format != 'text' and (args.trusted or args.untrusted or
+            args.open_in_dispvm):
+        error('--format can only be used when checking trust')
+        sys.exit(64)
+
     if args.printfolders:
         print_folders()
         return
 
+    if args.rules_generation:
+        print('{} {}'.format(*rules_generation()))
+        return
+
+    if args.open_in_dispvm:
+        paths = [os.path.abspath(path) for path in args.paths]
+        sys.exit(0 if open_many_in_dispvm(paths) else 69)
+
     checking_multiple = args.check_multiple or \
                         args.check_multiple_all_untrusted
 
+    if args.check_dir:
+        verdicts = []
+        for path in args.paths:
+            try:
+                verdicts += check_directory(path)
+            except (IOError, OSError) as err:
+                error('Unable to list {}: {}'.format(path,
+                        err.strerror or err))
+                sys.exit(65)
+
+        untrusted_found, all_untrusted = write_verdicts(verdicts,
+                                                        args.format)
+        if args.check_multiple_all_untrusted:
+            sys.exit(1 if all_untrusted else 0)
+        sys.exit(1 if untrusted_found else 0)
+
+    # Hash a batch of files up front, in parallel
+    if (checking_multiple or args.format != 'text') and \
+       any(load_hash_lists()):
+        hash_files([path for path in args.paths if os.path.isfile(path)])
+
+    # Machine readable output checks every path, then exits like
+    # --check-multiple(-all-untrusted) would
+    if args.format != 'text':
+        untrusted_found, all_untrusted = write_verdicts(
+                (evaluate_path(os.path.abspath(path)) for path in args.paths),
+                args.format)
+        if args.check_multiple_all_untrusted:
+            sys.exit(1 if all_untrusted else 0)
+        sys.exit(1 if untrusted_found else 0)
+
     # Determine which action to take for each given path
     for path in args.paths:
         # Get absolute path
@@ -510,6 +1789,14 @@ def main():
                 # Check file
                 check_file(path, checking_multiple)
 
+        elif os.path.isdir(path) and args.folder_xattr:
+            if args.trusted:
+                # Set folder and its contents as trusted
+                change_folder_xattr(path, True)
+            elif args.untrusted:
+                # Set folder and its contents as untrusted
+                change_folder_xattr(path, False)
+
         elif os.path.isdir(path):
             if args.trusted:
                 # Set folder as trusted
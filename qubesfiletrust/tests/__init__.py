@@ -0,0 +1,145 @@
+# -*- coding: utf-8 -*-
+#
+# The Qubes OS Project, http://www.qubes-os.org
+#
+# Copyright (C) 2017 Andrew Morgan <andrew@amorgan.xyz>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+#
+#
+
+import unittest
+import unittest.mock
+import tempfile
+import io
+import os
+import socket
+import threading
+import qubesfiletrust.qvm_file_trust as qvm_file_trust
+
+class TrustTestCase(unittest.TestCase):
+    """Test case with its own scratch folder, self.root.
+
+    All of qvm_file_trust's rule lists, hash lists, state, digest index and
+    daemon socket point into it, starting out with no rules and no daemon.
+    Caches are cleared around each test and output is quiet, use patch() and
+    start_daemon() to change any of that.
+    """
+
+    def setUp(self):
+        super().setUp()
+        tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpdir.cleanup)
+
+        # Resolve the temporary folder itself, in case it's behind a symlink
+        self.root = os.path.realpath(tmpdir.name)
+        self.global_list = os.path.join(self.root, 'global.list')
+        self.local_list = os.path.join(self.root, 'local.list')
+        self.phrase_file = os.path.join(self.root, 'phrase')
+        self.trusted_list = os.path.join(self.root, 'trusted.sha256')
+        self.untrusted_list = os.path.join(self.root, 'untrusted.sha256')
+        self.missing = os.path.join(self.root, 'missing')
+
+        self.patch(GLOBAL_FOLDER_LOC=self.global_list,
+                   LOCAL_FOLDER_LOC=self.local_list,
+                   PHRASE_FILE_LOC=self.phrase_file,
+                   RULES_STATE_LOC=os.path.join(self.root, 'state'),
+                   GLOBAL_TRUSTED_HASHES_LOC=self.trusted_list,
+                   LOCAL_TRUSTED_HASHES_LOC=self.missing,
+                   GLOBAL_UNTRUSTED_HASHES_LOC=self.untrusted_list,
+                   LOCAL_UNTRUSTED_HASHES_LOC=self.missing,
+                   DAEMON_SOCKET_LOC=self.missing,
+                   DIGEST_INDEX_LOC=os.path.join(self.root, 'digests'),
+                   OUTPUT_QUIET=True)
+        self.write_rules([], [])
+
+        qvm_file_trust.clear_caches()
+        self.addCleanup(qvm_file_trust.clear_caches)
+
+    def patch(self, **values):
+        """Replace qvm_file_trust globals until the test ends"""
+
+        for name, value in values.items():
+            patcher = unittest.mock.patch.object(qvm_file_trust, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def start_daemon(self, reply):
+        """Answer queries the way qubes-trust-daemon would until the test
+        ends. reply is the bytes to send back, or a function returning them
+        for each query, None to hold on to the query without answering.
+        Queries are collected in self.daemon_queries"""
+
+        socket_path = os.path.join(self.root, 'daemon.sock')
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        server.bind(socket_path)
+        server.listen(16)
+        server.settimeout(0.05)
+        self.addCleanup(server.close)
+        self.patch(DAEMON_SOCKET_LOC=socket_path)
+        self.daemon_queries = []
+        stopped = threading.Event()
+
+        def serve():
+            while not stopped.is_set():
+                try:
+                    client, _ = server.accept()
+                except socket.timeout:
+                    continue
+
+                with client:
+                    query = client.makefile('rb').readline()
+                    self.daemon_queries.append(query)
+                    answer = reply(query) if callable(reply) else reply
+                    if answer is None:
+                        # Wait for the client to give up
+                        client.recv(1)
+                    else:
+                        client.sendall(answer)
+
+        thread = threading.Thread(target=serve)
+        thread.start()
+        self.addCleanup(thread.join)
+        self.addCleanup(stopped.set)
+
+    def write_lines(self, path, lines):
+        with open(path, 'w') as list_file:
+            list_file.write(''.join(line + '\n' for line in lines))
+
+    def write_rules(self, global_rules, local_rules, phrase_lines=()):
+        """Write the rule lists. Rules already loaded are kept until the
+        caches are cleared or refreshed"""
+
+        self.write_lines(self.global_list, global_rules)
+        self.write_lines(self.local_list, local_rules)
+        self.write_lines(self.phrase_file, phrase_lines)
+
+    def make_file(self, folder, name, contents=b''):
+        path = os.path.join(folder, name)
+        with open(path, 'wb') as new_file:
+            new_file.write(contents)
+        return path
+
+    def run_main(self, *args):
+        """Run qvm-file-trust, returning its exit code and raw stdout"""
+
+        stdout = io.TextIOWrapper(io.BytesIO())
+        with unittest.mock.patch('sys.argv', ['qvm-file-trust'] + list(args)), \
+             unittest.mock.patch('sys.stdout', stdout), \
+             self.assertRaises(SystemExit) as cm:
+            qvm_file_trust.main()
+
+        stdout.flush()
+        return cm.exception.code, stdout.buffer.getvalue()
@@ -0,0 +1,218 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+#
+# The Qubes OS Project, http://www.qubes-os.org
+#
+# Copyright (C) 2017 Andrew Morgan <andrew@amorgan.xyz>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+#
+#
+
+import unittest
+import unittest.mock
+import asyncio
+import threading
+import hashlib
+import subprocess
+import sys
+import os
+import qubesfiletrust.async_trust as async_trust
+import qubesfiletrust.qvm_file_trust as qvm_file_trust
+from qubesfiletrust.tests import TrustTestCase
+
+class TC_00_check_many(TrustTestCase):
+    def setUp(self):
+        super().setUp()
+        self.untrusted = os.path.join(self.root, 'untrusted')
+        os.mkdir(self.untrusted)
+        self.write_rules([self.untrusted], [])
+
+        self.loop = asyncio.new_event_loop()
+        self.addCleanup(self.loop.close)
+
+    def make_files(self, folder, count):
+        return [self.make_file(folder, str(i)) for i in range(count)]
+
+    def collect(self, paths, **kwargs):
+        async def collect():
+            return [verdict async for verdict in
+                    async_trust.check_many(paths, **kwargs)]
+
+        return self.loop.run_until_complete(collect())
+
+    def test_000_all_paths_checked(self):
+        """Every path gets a verdict, matching the synchronous check"""
+        trusted = self.make_files(self.root, 100)
+        untrusted = self.make_files(self.untrusted, 100)
+
+        verdicts = self.collect(trusted + untrusted, workers=4)
+
+        self.assertCountEqual(verdicts, [qvm_file_trust.evaluate_path(path)
+                for path in trusted + untrusted])
+        self.assertEqual({verdict.path for verdict in verdicts
+                          if verdict.untrusted}, set(untrusted))
+
+    def test_001_bounded_workers(self):
+        """No more than the given number of checks run at once"""
+        lock = threading.Lock()
+        running = [0]
+        most_running = [0]
+
+        def evaluate_path(path):
+            with lock:
+                running[0] += 1
+                most_running[0] = max(most_running[0], running[0])
+            threading.Event().wait(0.005)
+            with lock:
+                running[0] -= 1
+            return qvm_file_trust.TrustVerdict(path, False, None, None)
+
+        with unittest.mock.patch.object(qvm_file_trust, 'evaluate_path',
+                evaluate_path):
+            verdicts = self.collect([str(i) for i in range(50)], workers=3)
+
+        self.assertEqual(len(verdicts), 50)
+        self.assertLessEqual(most_running[0], 3)
+
+    def test_002_incremental_results(self):
+        """Fast checks aren't held back by a slow one"""
+        release = threading.Event()
+
+        def evaluate_path(path):
+            if path == 'slow':
+                release.wait(10)
+            return qvm_file_trust.TrustVerdict(path, False, None, None)
+
+        async def first_paths():
+            seen = []
+            async for verdict in async_trust.check_many(
+                    ['slow'] + [str(i) for i in range(10)], workers=2):
+                seen.append(verdict.path)
+                if len(seen) == 10:
+                    release.set()
+            return seen
+
+        with unittest.mock.patch.object(qvm_file_trust, 'evaluate_path',
+                evaluate_path):
+            seen = self.loop.run_until_complete(first_paths())
+
+        self.assertEqual(seen[-1], 'slow')
+        self.assertCountEqual(seen[:-1], [str(i) for i in range(10)])
+
+    def test_003_cancel(self):
+        """Cancelling stops checks that haven't started yet"""
+        started = []
+        release = threading.Event()
+
+        def evaluate_path(path):
+            started.append(path)
+            release.wait(10)
+            return qvm_file_trust.TrustVerdict(path, False, None, None)
+
+        async def consume():
+            async for _ in async_trust.check_many(
+                    [str(i) for i in range(1000)], workers=2):
+                pass
+
+        async def cancel_soon():
+            task = self.loop.create_task(consume())
+            while len(started) < 2:
+                await asyncio.sleep(0.01)
+            task.cancel()
+            with self.assertRaises(asyncio.CancelledError):
+                await task
+
+        with unittest.mock.patch.object(qvm_file_trust, 'evaluate_path',
+                evaluate_path):
+            self.loop.run_until_complete(cancel_soon())
+            release.set()
+
+        self.assertEqual(len(started), 2)
+
+    def test_004_close_early(self):
+        """Stopping iteration early leaves the rest unchecked"""
+        paths = self.make_files(self.root, 100)
+
+        async def first():
+            checks = async_trust.check_many(paths, workers=2)
+            verdict = await checks.__anext__()
+            await checks.aclose()
+            return verdict
+
+        with unittest.mock.patch.object(qvm_file_trust, 'evaluate_path',
+                wraps=qvm_file_trust.evaluate_path) as evaluate_path:
+            self.assertIn(self.loop.run_until_complete(first()).path, paths)
+
+        self.assertLessEqual(evaluate_path.call_count, 3)
+
+    def test_005_rules_refreshed(self):
+        """Each batch picks up rules changed since the last one"""
+        path, = self.make_files(self.root, 1)
+        self.assertFalse(self.collect([path])[0].untrusted)
+
+        self.write_rules([self.root], [])
+
+        self.assertTrue(self.collect([path])[0].untrusted)
+
+    def test_006_folder_marker_refreshed(self):
+        """Each batch picks up folder markers set by other processes"""
+        docs = os.path.join(self.root, 'docs')
+        os.makedirs(os.path.join(docs, 'sub'))
+        path = self.make_file(os.path.join(docs, 'sub'), 'f')
+        self.assertFalse(self.collect([path])[0].untrusted)
+
+        subprocess.check_call([sys.executable, '-c',
+                'import sys, xattr; '
+                'xattr.setxattr(sys.argv[1], "user.qubes.untrusted", b"true")',
+                docs])
+
+        self.assertEqual(self.collect([path]), [qvm_file_trust.TrustVerdict(
+                path, True, 'folder-xattr', None)])
+
+    def test_007_symlink_refreshed(self):
+        """Each batch follows symlinks to where they point now"""
+        trusted = os.path.join(self.root, 'trusted')
+        os.mkdir(trusted)
+        link = os.path.join(self.root, 'link')
+        os.symlink(trusted, link)
+        path = os.path.join(link, 'f')
+        self.make_file(trusted, 'f')
+        self.make_file(self.untrusted, 'f')
+        self.assertFalse(self.collect([path])[0].untrusted)
+
+        os.unlink(link)
+        os.symlink(self.untrusted, link)
+
+        self.assertTrue(self.collect([path])[0].untrusted)
+
+    def test_008_hash_lists_refreshed(self):
+        """Each batch picks up changed hash lists"""
+        path = self.make_file(self.root, 'f', b'contents')
+        self.assertFalse(self.collect([path])[0].untrusted)
+
+        self.write_lines(self.untrusted_list,
+                         [hashlib.sha256(b'contents').hexdigest()])
+
+        self.assertEqual(self.collect([path]), [qvm_file_trust.TrustVerdict(
+                path, True, 'hash', None)])
+
+def list_tests():
+    return (
+            TC_00_check_many,
+    )
+
+if __name__ == '__main__':
+    unittest.main()
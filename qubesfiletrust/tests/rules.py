@@ -0,0 +1,349 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+#
+# The Qubes OS Project, http://www.qubes-os.org
+#
+# Copyright (C) 2017 Andrew Morgan <andrew@amorgan.xyz>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+#
+#
+
+import unittest
+import unittest.mock
+import random
+import tracemalloc
+import time
+import os
+import qubesfiletrust.qvm_file_trust as qvm_file_trust
+from qubesfiletrust.tests import TrustTestCase
+
+# Folder names that often share prefixes, so near misses get tested
+NAMES = ('a', 'b', 'ab', 'a b', 'b.a', 'untrusted', 'UnTrusted', 'x-y')
+PHRASES = ('', 'untrusted', 'ab', ' b', 'A B')
+
+def reference_folders(global_lines, local_lines):
+    """The untrusted folders the rule lists describe, worked out the simple
+    way: global rules in order, then local rules adding to or removing
+    from them"""
+
+    folders = set()
+    for local, lines in ((False, global_lines), (True, local_lines)):
+        for line in lines:
+            line = line.rstrip()
+            if not line or line.startswith('#'):
+                continue
+
+            line = os.path.normpath(line)
+            if line.startswith('-'):
+                if local:
+                    folders.discard(os.path.expanduser(line[1:]))
+                    continue
+                line = line[1:]
+
+            folders.add(os.path.expanduser(line))
+
+    return folders
+
+def reference_phrase(phrase_lines):
+    """The phrase is the first line that isn't a comment"""
+
+    for line in phrase_lines:
+        line = line.rstrip()
+        if not line.startswith('#'):
+            return line
+
+    return ''
+
+def reference_is_untrusted(path, folders, phrase):
+    """Check a path against every folder in turn"""
+
+    for folder in folders:
+        folder = os.path.abspath(folder)
+        if os.path.commonpath([folder]) == \
+           os.path.commonpath([folder, os.path.abspath(path)]):
+            return True
+
+    return bool(phrase) and phrase.upper() in path.upper()
+
+class RulesTestCase(TrustTestCase):
+    def setUp(self):
+        super().setUp()
+
+        # Nothing is created under root or home, so no path in them is a
+        # symlink
+        self.home = os.path.join(self.root, 'home', 'user')
+        patcher = unittest.mock.patch.dict(os.environ, {'HOME': self.home})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def write_rules(self, global_lines, local_lines, phrase_lines=()):
+        """Write the rule lists and forget the ones loaded before"""
+
+        super().write_rules(global_lines, local_lines, phrase_lines)
+        qvm_file_trust.clear_caches()
+
+class TC_00_reference_model(RulesTestCase):
+    CASES = 150
+    PATHS_PER_CASE = 150
+
+    def random_path(self, rng):
+        """A normalized absolute path under the test root or home"""
+
+        base = rng.choice((self.root, self.home))
+        return os.path.join(base, *(rng.choice(NAMES)
+                                    for _ in range(rng.randint(0, 5))))
+
+    def random_rule(self, rng):
+        """A folder rule, written in one of the many ways the lists allow"""
+
+        names = [rng.choice(NAMES) for _ in range(rng.randint(1, 3))]
+        style = rng.random()
+        if style < 0.2:
+            rule = '~/' + '/'.join(names)
+        elif style < 0.3:
+            rule = os.path.join(self.root, *names[:-1]) + '/./' + names[-1]
+        elif style < 0.4:
+            rule = os.path.join(self.root, *names) + '/../' + names[0]
+        elif style < 0.5:
+            rule = os.path.join(self.root, *names).replace('/', '//')
+            rule = '/' + rule.lstrip('/')
+        else:
+            rule = os.path.join(rng.choice((self.root, self.home)), *names)
+
+        return rule + rng.choice(('', '', '/', '//', ' ', '\t'))
+
+    def random_lines(self, rng, rules, local):
+        lines = []
+        for _ in range(rng.randint(0, 12)):
+            kind = rng.random()
+            if kind < 0.05:
+                lines.append('')
+            elif kind < 0.1:
+                lines.append('# ' + self.random_rule(rng))
+            elif kind < 0.35:
+                # Overrides, usually of a rule that was listed
+                if rules and rng.random() < 0.7:
+                    rule = rng.choice(rules).rstrip()
+                    if not rule.endswith('/') and rng.random() < 0.3:
+                        rule += '/'
+                else:
+                    rule = self.random_rule(rng)
+                lines.append('-' + rule)
+            else:
+                rule = self.random_rule(rng)
+                rules.append(rule)
+                lines.append(rule)
+
+        return lines
+
+    def random_case(self, seed):
+        rng = random.Random(seed)
+
+        rules = []
+        global_lines = self.random_lines(rng, rules, False)
+        local_lines = self.random_lines(rng, rules, True)
+        phrase_lines = rng.choice(([], ['# phrase'], [''])) + \
+                       [rng.choice(PHRASES)]
+
+        paths = []
+        for _ in range(self.PATHS_PER_CASE):
+            path = self.random_path(rng)
+            if rules and rng.random() < 0.3:
+                # Land exactly on a rule, or just inside or beside it
+                rule = os.path.expanduser(
+                        os.path.normpath(rng.choice(rules).rstrip()))
+                path = os.path.abspath(rule) + rng.choice(
+                        ('', '/' + rng.choice(NAMES), rng.choice(NAMES)))
+            paths.append(path)
+
+        return global_lines, local_lines, phrase_lines, paths
+
+    def test_000_folders(self):
+        """Rule lists are read the same as by the reference model"""
+        for seed in range(self.CASES):
+            global_lines, local_lines, _, _ = self.random_case(seed)
+            self.write_rules(global_lines, local_lines)
+
+            with self.subTest(seed=seed):
+                self.assertEqual(
+                        set(qvm_file_trust.retrieve_untrusted_folders()),
+                        reference_folders(global_lines, local_lines))
+
+    def test_001_phrase(self):
+        """The phrase is read the same as by the reference model"""
+        for seed in range(self.CASES):
+            _, _, phrase_lines, _ = self.random_case(seed)
+            self.write_rules([], [], phrase_lines)
+
+            with self.subTest(seed=seed):
+                self.assertEqual(qvm_file_trust.retrieve_untrusted_phrase(),
+                                 reference_phrase(phrase_lines))
+
+    def test_002_matching(self):
+        """Paths are judged the same as by the reference model"""
+        for seed in range(self.CASES):
+            global_lines, local_lines, phrase_lines, paths = \
+                    self.random_case(seed)
+            self.write_rules(global_lines, local_lines, phrase_lines)
+
+            folders = reference_folders(global_lines, local_lines)
+            phrase = reference_phrase(phrase_lines)
+
+            for path in paths:
+                with self.subTest(seed=seed, path=path):
+                    expected = reference_is_untrusted(path, folders, phrase)
+                    self.assertEqual(qvm_file_trust.is_untrusted_path(path),
+                                     expected)
+                    self.assertEqual(
+                            qvm_file_trust.untrusted_path_source(path)
+                            is not None, expected)
+
+    def test_003_refresh(self):
+        """Reloaded rules are judged the same as freshly read ones"""
+        for seed in range(0, self.CASES, 10):
+            global_lines, local_lines, phrase_lines, paths = \
+                    self.random_case(seed)
+            for path, lines in ((self.global_list, global_lines),
+                                (self.local_list, local_lines),
+                                (self.phrase_file, phrase_lines)):
+                self.write_lines(path, lines)
+
+                # Make sure every rewrite is noticed, however quick
+                os.utime(path, ns=(seed, seed))
+
+            qvm_file_trust.load_untrusted_rules(refresh=True)
+
+            folders = reference_folders(global_lines, local_lines)
+            phrase = reference_phrase(phrase_lines)
+            for path in paths:
+                with self.subTest(seed=seed, path=path):
+                    self.assertEqual(qvm_file_trust.is_untrusted_path(path),
+                            reference_is_untrusted(path, folders, phrase))
+
+    def test_010_unmatched_override(self):
+        """An override of a folder that isn't listed is skipped, and the
+        rest of the local list still applies"""
+        kept = os.path.join(self.root, 'kept')
+        self.write_rules([], ['-' + os.path.join(self.root, 'not-listed'),
+                              kept])
+
+        self.assertEqual(qvm_file_trust.retrieve_untrusted_folders(), [kept])
+        self.assertTrue(qvm_file_trust.is_untrusted_path(
+                os.path.join(kept, 'file')))
+
+class TC_10_scale(RulesTestCase):
+    RULES = 100000
+    PATHS = 1000000
+
+    def large_rules(self):
+        """RULES folders in the global list, with every tenth one
+        overridden in the local list"""
+
+        rules = [os.path.join(self.root, 'r{}'.format(i // 100),
+                              str(i % 100)) for i in range(self.RULES)]
+        self.write_rules(rules, ['-' + rule for rule in rules[::10]])
+        return rules
+
+    def large_paths(self):
+        """PATHS paths, a tenth of them in a folder beyond the rules, along
+        with whether each should be untrusted"""
+
+        folders = self.RULES * 11 // 10
+        for i in range(self.PATHS):
+            folder = i % folders
+            path = os.path.join(self.root, 'r{}'.format(folder // 100),
+                                str(folder % 100), 'sub', str(i))
+            yield path, folder < self.RULES and folder % 10 != 0
+
+    def test_000_load_rules(self):
+        """Loading 100k rules is quick and doesn't take much memory"""
+        self.large_rules()
+
+        start = time.perf_counter()
+        untrusted_folders, _ = qvm_file_trust.load_untrusted_rules()
+        elapsed = time.perf_counter() - start
+
+        self.assertEqual(len(untrusted_folders), self.RULES * 9 // 10)
+        self.assertLess(elapsed, 10)
+
+        qvm_file_trust.clear_caches()
+        tracemalloc.start()
+        try:
+            qvm_file_trust.load_untrusted_rules()
+            _, peak = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+
+        self.assertLess(peak, 64 * 1024 * 1024)
+
+    def test_001_match_paths(self):
+        """Checking 1M paths against 100k rules is quick, gets them all
+        right and doesn't build up the folder caches"""
+        rules = self.large_rules()
+        qvm_file_trust.load_untrusted_rules()
+
+        wrong = 0
+        start = time.perf_counter()
+        for path, expected in self.large_paths():
+            wrong += qvm_file_trust.is_untrusted_path(path) != expected
+        elapsed = time.perf_counter() - start
+
+        self.assertEqual(wrong, 0)
+        self.assertLess(elapsed, 120)
+        self.assertLessEqual(len(qvm_file_trust.REALPATH_CACHE),
+                             qvm_file_trust.FOLDER_CACHE_SIZE)
+
+        # Paths in 100k different folders, with the caches starting out
+        # empty, would take tens of MB if every folder was kept
+        qvm_file_trust.REALPATH_CACHE.clear()
+        tracemalloc.start()
+        try:
+            before, _ = tracemalloc.get_traced_memory()
+            for path, _ in zip(self.large_paths(), range(100000)):
+                qvm_file_trust.is_untrusted_path(path[0])
+            _, peak = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+
+        self.assertLess(peak - before, 4 * 1024 * 1024)
+
+        # Spot check against the reference model
+        rng = random.Random(0)
+        sample = rng.sample(rules, 3)
+        folders = set(rules) - set(rules[::10])
+        for rule in sample:
+            path = os.path.join(rule, 'file')
+            self.assertEqual(qvm_file_trust.is_untrusted_path(path),
+                             reference_is_untrusted(path, folders, ''))
+
+    def test_002_folder_trust_cache(self):
+        """Walking up 100k folders for their xattrs doesn't build up the
+        folder trust cache"""
+        for i in range(100000):
+            qvm_file_trust.is_untrusted_folder_xattr(os.path.join(self.root,
+                    'r{}'.format(i // 100), str(i % 100)))
+
+        self.assertLessEqual(len(qvm_file_trust.FOLDER_TRUST_CACHE),
+                             qvm_file_trust.FOLDER_CACHE_SIZE)
+
+def list_tests():
+    return (
+            TC_00_reference_model,
+            TC_10_scale
+    )
+
+if __name__ == '__main__':
+    unittest.main()
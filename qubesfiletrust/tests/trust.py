@@ -23,16 +23,34 @@
 
 import unittest
 import unittest.mock
+import errno
+import json
 import getpass
+import hashlib
 import xattr
 import sys
 import io
 import os
+import mmap
+import threading
+import time
 import qubesfiletrust.qvm_file_trust as qvm_file_trust
+from qubesfiletrust.tests import TrustTestCase
 
 user_home = os.path.expanduser('~')
 
 class TC_00_trust(unittest.TestCase):
+    def setUp(self):
+        # Some tests below replace these outright, put them back afterwards
+        self.orig_funcs = [(module, name, getattr(module, name))
+                for module, name in ((os, 'stat'), (os, 'chmod'),
+                    (xattr, 'get'), (xattr, 'get_all'), (xattr, 'setxattr'),
+                    (xattr, 'removexattr'))]
+        qvm_file_trust.clear_caches()
+
+    def tearDown(self):
+        for module, name, func in self.orig_funcs:
+            setattr(module, name, func)
 
     @unittest.mock.patch('qubesfiletrust.qvm_file_trust.open', 
             new_callable=unittest.mock.mock_open(), create=True)
@@ -103,30 +121,28 @@ class TC_00_trust(unittest.TestCase):
 
     def test_010_check_read_attribute_success(self):
         """Check whether our untrusted attribute is successfully found"""
-        xattr.get_all = unittest.mock.MagicMock(
-                return_value=[(b'user.qubes.untrusted', b'true'), 
-                              (b'user.something.else', b'false')])
-        os.chmod = unittest.mock.MagicMock()
 
-        test_result = False
-        try:
-            test_result = qvm_file_trust.is_untrusted_xattr('', '777') 
-            self.assertTrue(test_result)
-        except SystemExit as err: 
-            self.fail('System Exit caught: {}'.format(err))
+        # Both the legacy value and a packed record
+        for value in (b'true', qvm_file_trust.pack_trust_record(
+                qvm_file_trust.TrustRecord(True, 'work', 1, '', 0o644))):
+            xattr.get = unittest.mock.MagicMock(return_value=value)
+
+            record = qvm_file_trust.read_trust_record('')
+            self.assertTrue(record.untrusted)
 
     def test_011_check_read_attribute_failure(self):
         """Check whether we support not finding our attribute"""
-        xattr.get_all = unittest.mock.MagicMock(
-                return_value=['user.bla.something', 'user.something.else'])
-        os.chmod = unittest.mock.MagicMock()
+        xattr.get = unittest.mock.MagicMock(
+                side_effect=OSError(errno.ENODATA, 'No data available'))
 
-        test_result = True
-        try:
-            test_result = qvm_file_trust.is_untrusted_xattr('', '777') 
-            self.assertFalse(test_result)
-        except SystemExit as err: 
-            self.fail('System Exit caught: {}'.format(err))
+        self.assertIsNone(qvm_file_trust.read_trust_record(''))
+
+        # Any other error is left to the caller
+        xattr.get = unittest.mock.MagicMock(
+                side_effect=OSError(errno.EACCES, 'Permission denied'))
+
+        with self.assertRaises(OSError):
+            qvm_file_trust.read_trust_record('')
 
     @unittest.mock.patch('qubesfiletrust.qvm_file_trust.open', 
             new_callable=unittest.mock.mock_open(), create=True)
@@ -244,8 +260,8 @@ class TC_00_trust(unittest.TestCase):
 
         # When an exception is raised, make sure it is exit code 77
         # i.e., chmod issue
-        with self.assertRaises(SystemExit) as cm:
-            qvm_file_trust.OUTPUT_QUIET = True
+        with unittest.mock.patch.object(qvm_file_trust, 'OUTPUT_QUIET', True), \
+             self.assertRaises(SystemExit) as cm:
             qvm_file_trust.change_file('', True)
 
         self.assertEqual(cm.exception.code, 77)
@@ -255,20 +271,27 @@ class TC_00_trust(unittest.TestCase):
         os.chmod = unittest.mock.MagicMock()
 
         # Dummy data
-        os.stat = unittest.mock.Mock()
-        os.stat.st_mode = 0
+        os.stat = unittest.mock.Mock(
+                return_value=os.stat_result((0o100640,) + (0,) * 9))
 
+        xattr.get = unittest.mock.MagicMock(return_value=b'true')
         xattr.removexattr = unittest.mock.MagicMock()
         qvm_file_trust.change_file('do_trust_me', True)
 
         xattr.removexattr.assert_called_once_with('do_trust_me',
                 'user.qubes.untrusted')
 
+        xattr.get = unittest.mock.MagicMock(
+                side_effect=OSError(errno.ENODATA, 'No data available'))
         xattr.setxattr = unittest.mock.MagicMock()
-        qvm_file_trust.change_file('dont_trust_me', False)
+        qvm_file_trust.change_file('dont_trust_me', False, rule='')
 
         xattr.setxattr.assert_called_once_with('dont_trust_me',
-                'user.qubes.untrusted', 'true')
+                'user.qubes.untrusted', unittest.mock.ANY)
+        record = qvm_file_trust.parse_trust_record(
+                xattr.setxattr.call_args[0][2])
+        self.assertTrue(record.untrusted)
+        self.assertEqual(record.mode, 0o640)
 
     '''
     # TODO: Do some tests based on command line arguments and that correct
@@ -278,6 +301,12 @@ class TC_00_trust(unittest.TestCase):
     '''
 
 class TC_10_misc(unittest.TestCase):
+    def setUp(self):
+        patcher = unittest.mock.patch.object(qvm_file_trust, 'OUTPUT_QUIET',
+                False)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
     def test_000_quiet(self):
         """Make sure we're not printing when we shouldn't be."""
         qvm_file_trust.OUTPUT_QUIET = True
@@ -322,10 +351,1078 @@ class TC_10_misc(unittest.TestCase):
             sys.stdout = sys.__stdout__
             self.assertEqual(captured_obj.getvalue(), '')
 
+class TC_20_daemon(TrustTestCase):
+    def setUp(self):
+        super().setUp()
+
+        # The daemon only watches untrusted folders
+        self.watched = os.path.join(self.root, 'watched')
+        os.mkdir(self.watched)
+        self.write_rules([self.watched], [])
+
+    def test_000_pending_path_is_untrusted(self):
+        """A path queued in the daemon is reported untrusted"""
+        self.start_daemon(b'UNTRUSTED\n')
+        path = os.path.join(self.watched, 'new file.pdf')
+
+        self.assertTrue(qvm_file_trust.is_pending_untrusted(path))
+        self.assertEqual(self.daemon_queries, [os.fsencode(path) + b'\n'])
+
+    def test_001_unknown_path_falls_through(self):
+        """A path the daemon isn't holding is left to the other checks"""
+        self.start_daemon(b'UNKNOWN\n')
+
+        self.assertFalse(qvm_file_trust.is_pending_untrusted(
+                os.path.join(self.watched, 'a')))
+
+    def test_002_no_daemon(self):
+        """Checks still work when the daemon isn't running"""
+        self.assertFalse(qvm_file_trust.is_pending_untrusted(
+                os.path.join(self.watched, 'a')))
+
+    def test_003_pending_names(self):
+        """A folder's queued files are asked for in one query per form of
+        the folder's path"""
+        folder = os.path.join(self.watched, 'folder')
+        link = os.path.join(self.root, 'link')
+        os.mkdir(folder)
+        os.symlink(folder, link)
+        self.write_rules([self.watched, link], [])
+        self.start_daemon(lambda query: b'new file\0other\n'
+                          if query == b'LIST ' + os.fsencode(link) + b'\n'
+                          else b'\n')
+
+        self.assertEqual(qvm_file_trust.pending_untrusted_names(link, folder),
+                         {'new file', 'other'})
+        self.assertEqual(sorted(self.daemon_queries),
+                [b'LIST ' + os.fsencode(path) + b'\n'
+                 for path in sorted((folder, link))])
+
+    def test_004_incomplete_pending_names(self):
+        """A listing cut short means any file may be queued"""
+        self.start_daemon(b'new file\0oth')
+
+        self.assertIsNone(
+                qvm_file_trust.pending_untrusted_names(self.watched))
+
+    def test_005_no_daemon_pending_names(self):
+        """Listings still work when the daemon isn't running"""
+        self.assertEqual(qvm_file_trust.pending_untrusted_names(self.watched),
+                         set())
+
+    def test_006_no_answer(self):
+        """A daemon that is running but doesn't answer in time may be
+        holding the file, so it's untrusted"""
+        self.patch(DAEMON_TIMEOUT=0.2)
+        self.start_daemon(None)
+        path = self.make_file(self.watched, 'incoming')
+
+        self.assertTrue(qvm_file_trust.is_pending_untrusted(path))
+        self.assertEqual(qvm_file_trust.evaluate_path(path),
+                qvm_file_trust.TrustVerdict(path, True, 'daemon', None))
+        self.assertIsNone(
+                qvm_file_trust.pending_untrusted_names(self.watched))
+
+    def test_007_dropped_query(self):
+        """A daemon that hangs up without answering is treated the same"""
+        self.start_daemon(b'')
+
+        self.assertTrue(qvm_file_trust.is_pending_untrusted(
+                os.path.join(self.watched, 'a')))
+
+    def test_008_listing_no_answer(self):
+        """When the daemon doesn't answer about a folder, its files are
+        untrusted but its folders aren't"""
+        self.patch(DAEMON_TIMEOUT=0.2)
+        self.start_daemon(None)
+        self.make_file(self.watched, 'incoming')
+        os.mkdir(os.path.join(self.watched, 'folder'))
+
+        verdicts = {os.path.basename(verdict.path):
+                    (verdict.untrusted, verdict.source)
+                    for verdict in
+                    qvm_file_trust.check_directory(self.watched)}
+
+        self.assertEqual(verdicts['incoming'], (True, 'daemon'))
+        self.assertEqual(verdicts['folder'], (True, 'folder-rule'))
+
+    def test_009_unwatched_paths_not_asked(self):
+        """Paths outside untrusted folders don't wait on the daemon"""
+        self.patch(DAEMON_TIMEOUT=0.2)
+        self.start_daemon(None)
+        path = self.make_file(self.root, 'document')
+
+        self.assertFalse(qvm_file_trust.is_pending_untrusted(path))
+        self.assertEqual(qvm_file_trust.evaluate_path(path),
+                qvm_file_trust.TrustVerdict(path, False, None, None))
+        self.assertEqual(qvm_file_trust.pending_untrusted_names(self.root),
+                         set())
+        self.assertEqual(self.daemon_queries, [])
+
+    def test_010_check_file_asks_daemon(self):
+        """check_file trusts the daemon's answer over a missing xattr"""
+        self.start_daemon(b'UNTRUSTED\n')
+        path = self.make_file(self.watched, 'incoming')
+
+        with self.assertRaises(SystemExit) as cm:
+            qvm_file_trust.check_file(path, False)
+
+        self.assertEqual(cm.exception.code, 1)
+        self.assertEqual(self.daemon_queries, [os.fsencode(path) + b'\n'])
+
+class TC_30_open_in_dispvm(TrustTestCase):
+    def setUp(self):
+        super().setUp()
+        self.log = os.path.join(self.root, 'opened.log')
+        self.patch(is_untrusted_file=lambda path: True,
+                   QVM_OPEN_IN_VM_LOC=self.stand_in(0))
+
+    def stand_in(self, exit_code):
+        """Write a qvm-open-in-vm replacement logging each file's mode"""
+        script = os.path.join(self.root,
+                'qvm-open-in-vm-{}'.format(exit_code))
+        with open(script, 'w') as script_file:
+            script_file.write('#!/bin/sh\n'
+                    'echo "$1 $(stat -c %a "$2") $2" >> {}\n'
+                    'exit {}\n'.format(self.log, exit_code))
+        os.chmod(script, 0o755)
+        return script
+
+    def make_files(self, count):
+        paths = []
+        for i in range(count):
+            path = self.make_file(self.root, 'file {}'.format(i))
+            os.chmod(path, 0)
+            paths.append(path)
+        return paths
+
+    def opened(self):
+        with open(self.log) as log:
+            return sorted(line.rstrip('\n') for line in log)
+
+    def test_000_open_and_relock(self):
+        """Files are unlocked for the open and locked again afterwards"""
+        paths = self.make_files(10)
+
+        self.assertTrue(qvm_file_trust.open_many_in_dispvm(paths))
+
+        self.assertEqual(self.opened(),
+                sorted('$dispvm 600 {}'.format(path) for path in paths))
+        for path in paths:
+            self.assertEqual(os.stat(path).st_mode & 0o7777, 0)
+
+    def test_001_relock_on_failure(self):
+        """Original permissions come back even if the open fails"""
+        path, = self.make_files(1)
+        os.chmod(path, 0o640)
+
+        with unittest.mock.patch.object(qvm_file_trust,
+                'QVM_OPEN_IN_VM_LOC', self.stand_in(1)):
+            self.assertFalse(qvm_file_trust.open_many_in_dispvm([path]))
+
+        self.assertEqual(os.stat(path).st_mode & 0o7777, 0o640)
+
+    def test_002_missing_qvm_open_in_vm(self):
+        """Original permissions come back if qvm-open-in-vm can't run"""
+        path, = self.make_files(1)
+
+        with unittest.mock.patch.object(qvm_file_trust,
+                'QVM_OPEN_IN_VM_LOC', os.path.join(self.root, 'nope')):
+            self.assertFalse(qvm_file_trust.open_many_in_dispvm([path]))
+
+        self.assertEqual(os.stat(path).st_mode & 0o7777, 0)
+
+    def test_003_trusted_file_not_opened(self):
+        """Trusted files are left alone"""
+        path, = self.make_files(1)
+
+        with unittest.mock.patch.object(qvm_file_trust,
+                'is_untrusted_file', lambda path: False):
+            self.assertTrue(qvm_file_trust.open_many_in_dispvm([path]))
+
+        self.assertFalse(os.path.exists(self.log))
+
+    def test_004_duplicate_paths(self):
+        """A file given twice is only opened once"""
+        path, = self.make_files(1)
+
+        self.assertTrue(qvm_file_trust.open_many_in_dispvm([path, path]))
+
+        self.assertEqual(self.opened(), ['$dispvm 600 {}'.format(path)])
+        self.assertEqual(os.stat(path).st_mode & 0o7777, 0)
+
+class TC_40_folder_xattr(TrustTestCase):
+    def setUp(self):
+        super().setUp()
+        self.outer = os.path.join(self.root, 'outer')
+        self.middle = os.path.join(self.outer, 'middle')
+        self.inner = os.path.join(self.middle, 'inner')
+        os.makedirs(self.inner)
+
+    def test_000_inherit_from_ancestor(self):
+        """Folders inherit untrusted status from a marked ancestor"""
+        self.assertFalse(qvm_file_trust.is_untrusted_folder_xattr(self.inner))
+
+        qvm_file_trust.change_folder_xattr(self.outer, False)
+
+        self.assertTrue(qvm_file_trust.is_untrusted_folder_xattr(self.inner))
+        self.assertTrue(qvm_file_trust.is_untrusted_folder_xattr(self.outer))
+        self.assertFalse(qvm_file_trust.is_untrusted_folder_xattr(
+                self.root))
+
+    def test_001_trusted_marker_stops_inheritance(self):
+        """Trusting a folder under an untrusted one shields its contents"""
+        qvm_file_trust.change_folder_xattr(self.outer, False)
+        qvm_file_trust.change_folder_xattr(self.middle, True)
+
+        self.assertFalse(qvm_file_trust.read_trust_record(
+                self.middle).untrusted)
+        self.assertFalse(qvm_file_trust.is_untrusted_folder_xattr(self.inner))
+        self.assertTrue(qvm_file_trust.is_untrusted_folder_xattr(self.outer))
+
+        # Marking it untrusted again overrides the trusted marker
+        qvm_file_trust.change_folder_xattr(self.middle, False)
+        self.assertTrue(qvm_file_trust.is_untrusted_folder_xattr(self.inner))
+
+    def test_002_trust_removes_marker(self):
+        """Trusting a marked folder with no marked ancestor clears it"""
+        qvm_file_trust.change_folder_xattr(self.outer, False)
+        qvm_file_trust.change_folder_xattr(self.outer, True)
+
+        self.assertIsNone(qvm_file_trust.folder_xattr_trust(self.outer))
+        self.assertFalse(qvm_file_trust.is_untrusted_folder_xattr(self.inner))
+
+    def test_003_ancestors_read_once(self):
+        """Sibling lookups reuse the cached walk up the tree"""
+        siblings = [os.path.join(self.inner, str(i)) for i in range(5)]
+        for sibling in siblings:
+            os.mkdir(sibling)
+
+        with unittest.mock.patch.object(qvm_file_trust, 'folder_xattr_trust',
+                wraps=qvm_file_trust.folder_xattr_trust) as reads:
+            for sibling in siblings:
+                qvm_file_trust.is_untrusted_folder_xattr(sibling)
+
+        read_paths = [call[0][0] for call in reads.call_args_list]
+        self.assertEqual(len(read_paths), len(set(read_paths)))
+        self.assertEqual(read_paths.count(self.outer), 1)
+
+    def test_004_file_inherits(self):
+        """Files are untrusted when a parent folder is marked"""
+        path = self.make_file(self.inner, 'file')
+
+        with unittest.mock.patch.object(qvm_file_trust,
+                'untrusted_path_source', return_value=None):
+            self.assertFalse(qvm_file_trust.is_untrusted_file(path))
+            qvm_file_trust.change_folder_xattr(self.outer, False)
+            self.assertTrue(qvm_file_trust.is_untrusted_file(path))
+
+    def test_005_symlinked_folder(self):
+        """A symlink to a folder inherits what the folder it points to does,
+        like the files in it"""
+        link = os.path.join(self.root, 'innerlink')
+        os.symlink(self.inner, link)
+        self.make_file(self.inner, 'x')
+        qvm_file_trust.change_folder_xattr(self.outer, False)
+
+        for path in (link, os.path.join(link, 'x')):
+            self.assertEqual(qvm_file_trust.evaluate_path(path),
+                    qvm_file_trust.TrustVerdict(path, True, 'folder-xattr',
+                                                None))
+
+class TC_50_canonical_paths(TrustTestCase):
+    def setUp(self):
+        super().setUp()
+        self.untrusted = os.path.join(self.root, 'untrusted')
+        self.other = os.path.join(self.root, 'other')
+        os.mkdir(self.untrusted)
+        os.mkdir(self.other)
+
+    def test_000_symlink_into_untrusted_folder(self):
+        """Paths through a symlink into an untrusted folder are untrusted"""
+        self.write_rules([self.untrusted], [])
+        link = os.path.join(self.other, 'link')
+        os.symlink(self.untrusted, link)
+
+        self.assertTrue(qvm_file_trust.is_untrusted_path(
+                os.path.join(link, 'file')))
+        self.assertFalse(qvm_file_trust.is_untrusted_path(
+                os.path.join(self.other, 'file')))
+
+    def test_001_symlinked_file(self):
+        """A symlink to an untrusted file is untrusted"""
+        self.write_rules([self.untrusted], [])
+        target = self.make_file(self.untrusted, 'file')
+        link = os.path.join(self.other, 'file')
+        os.symlink(target, link)
+
+        self.assertTrue(qvm_file_trust.is_untrusted_path(link))
+
+    def test_002_symlinked_rule(self):
+        """Rules pointing at a symlink cover the folder it points to"""
+        link = os.path.join(self.other, 'link')
+        os.symlink(self.untrusted, link)
+        self.write_rules([], [link + '/'])
+
+        self.assertTrue(qvm_file_trust.is_untrusted_path(
+                os.path.join(self.untrusted, 'file')))
+
+    def test_003_similar_folder_names(self):
+        """Rules only match whole path components"""
+        self.write_rules([self.untrusted], [])
+
+        self.assertTrue(qvm_file_trust.is_untrusted_path(self.untrusted))
+        self.assertFalse(qvm_file_trust.is_untrusted_path(
+                self.untrusted + '-not'))
+
+    def test_004_symlink_out_of_untrusted_folder(self):
+        """Paths in an untrusted folder stay untrusted when a symlink on
+        them leads elsewhere"""
+        self.write_rules([self.untrusted], [])
+        target = self.make_file(self.other, 'file')
+        os.symlink(self.other, os.path.join(self.untrusted, 'dirlink'))
+        os.symlink(target, os.path.join(self.untrusted, 'link'))
+
+        for path in (os.path.join(self.untrusted, 'dirlink', 'file'),
+                     os.path.join(self.untrusted, 'link')):
+            self.assertTrue(qvm_file_trust.is_untrusted_path(path))
+            self.assertEqual(qvm_file_trust.evaluate_path(path),
+                    qvm_file_trust.TrustVerdict(path, True, 'folder-rule',
+                                                None))
+
+        self.assertFalse(qvm_file_trust.is_untrusted_path(target))
+
+    def test_010_parent_resolved_once(self):
+        """Siblings share a single resolution of their folder"""
+        paths = [os.path.join(self.untrusted, str(i)) for i in range(50)]
+
+        qvm_file_trust.canonical_path(paths[0])
+        with unittest.mock.patch('os.path.islink',
+                wraps=os.path.islink) as islink:
+            for path in paths[1:]:
+                qvm_file_trust.canonical_path(path)
+
+        # Only each file itself is looked at
+        self.assertEqual(islink.call_count, len(paths) - 1)
+
+    def test_011_rules_loaded_once(self):
+        """Rule lists are read once for a batch of checks"""
+        self.write_rules([self.untrusted], [])
+
+        with unittest.mock.patch.object(qvm_file_trust,
+                'retrieve_untrusted_folders',
+                wraps=qvm_file_trust.retrieve_untrusted_folders) as retrieve:
+            for i in range(10):
+                qvm_file_trust.is_untrusted_path(
+                        os.path.join(self.untrusted, str(i)))
+
+        self.assertEqual(retrieve.call_count, 1)
+
+    def test_012_change_folder_reloads_rules(self):
+        """Rules written by change_folder apply to later checks"""
+        path = os.path.join(self.other, 'file')
+        self.assertFalse(qvm_file_trust.is_untrusted_path(path))
+
+        # Don't create ~/.config/qubes for real
+        with unittest.mock.patch('os.makedirs'):
+            qvm_file_trust.change_folder(self.other, False)
+
+        self.assertTrue(qvm_file_trust.is_untrusted_path(path))
+
+class TC_60_content_hash(TrustTestCase):
+    def setUp(self):
+        super().setUp()
+        self.patch(untrusted_path_source=
+                   lambda path, real_path=None: 'folder-rule')
+
+    def make_hashed_file(self, name, contents):
+        return (self.make_file(self.root, name, contents),
+                hashlib.sha256(contents).hexdigest())
+
+    def test_000_trusted_and_untrusted_lists(self):
+        """Listed contents decide trust wherever the file lives"""
+        good, good_digest = self.make_hashed_file('good', b'good contents')
+        bad, bad_digest = self.make_hashed_file('bad', b'bad contents')
+        other, _ = self.make_hashed_file('other', b'other contents')
+
+        # Accept sha256sum output, upper case and comments
+        self.write_lines(self.trusted_list, ['# Known good',
+                '{}  good'.format(good_digest.upper()), bad_digest])
+        self.write_lines(self.untrusted_list, [bad_digest])
+
+        self.assertFalse(qvm_file_trust.is_untrusted_file(good))
+        self.assertTrue(qvm_file_trust.is_untrusted_file(bad))
+
+        # Unlisted files fall back to the other checks
+        self.assertIsNone(qvm_file_trust.is_untrusted_hash(other))
+        self.assertTrue(qvm_file_trust.is_untrusted_file(other))
+
+    def test_001_no_lists_no_hashing(self):
+        """Files aren't hashed when there are no lists"""
+        path, _ = self.make_hashed_file('file', b'contents')
+
+        with unittest.mock.patch.object(qvm_file_trust, 'hash_file') as hash_file:
+            self.assertIsNone(qvm_file_trust.is_untrusted_hash(path))
+
+        hash_file.assert_not_called()
+
+    def test_010_digests(self):
+        """Digests are right for empty, small and multi-page files"""
+        for name, contents in (('empty', b''), ('small', b'abc'),
+                               ('large', os.urandom(3 * mmap.PAGESIZE + 5))):
+            path, digest = self.make_hashed_file(name, contents)
+            self.assertEqual(qvm_file_trust.hash_file(path), digest)
+
+    def test_011_unchanged_files_hashed_once(self):
+        """A file is only hashed again once it has changed"""
+        path, digest = self.make_hashed_file('file', b'contents')
+
+        with unittest.mock.patch.object(qvm_file_trust, 'hash_file',
+                wraps=qvm_file_trust.hash_file) as hash_file:
+            self.assertEqual(qvm_file_trust.file_digest(path), digest)
+
+            # The xattr survives the in-process cache
+            qvm_file_trust.clear_caches()
+            self.assertEqual(qvm_file_trust.file_digest(path), digest)
+            self.assertEqual(hash_file.call_count, 1)
+
+            path, digest = self.make_hashed_file('file', b'new contents')
+            os.utime(path, ns=(0, 12345))
+            self.assertEqual(qvm_file_trust.file_digest(path), digest)
+            self.assertEqual(hash_file.call_count, 2)
+
+    def test_012_not_a_file(self):
+        """Folders and missing files have no digest"""
+        self.assertIsNone(qvm_file_trust.file_digest(self.root))
+        self.assertIsNone(qvm_file_trust.file_digest(
+                os.path.join(self.root, 'missing')))
+
+    def test_020_batch_hashing(self):
+        """Large batches are hashed in parallel with the same results"""
+        files = [self.make_hashed_file(str(i), os.urandom(i * 1000))
+                 for i in range(qvm_file_trust.HASH_PARALLEL_MIN * 2)]
+
+        with unittest.mock.patch.object(qvm_file_trust, 'HASH_JOBS', 4):
+            digests = qvm_file_trust.hash_files([path for path, _ in files])
+
+        self.assertEqual(digests, dict(files))
+
+    def as_other_user(self):
+        """Act as if we couldn't read locked files or their xattrs, like
+        anyone but root"""
+        denied = PermissionError(errno.EACCES, 'Permission denied')
+        return unittest.mock.patch.multiple(qvm_file_trust,
+                hash_file=unittest.mock.Mock(side_effect=denied),
+                xattr=unittest.mock.Mock(get=unittest.mock.Mock(
+                    side_effect=denied)))
+
+    def test_030_locked_files_still_listed(self):
+        """The untrusted list still decides once a file has been locked,
+        but the trusted list doesn't override the lock"""
+        good, good_digest = self.make_hashed_file('good', b'good contents')
+        bad, bad_digest = self.make_hashed_file('bad', b'bad contents')
+        self.write_lines(self.trusted_list, [good_digest])
+        self.write_lines(self.untrusted_list, [bad_digest])
+
+        for path in (good, bad):
+            qvm_file_trust.change_file(path, False, rule='')
+            self.assertEqual(os.stat(path).st_mode & 0o7777, 0)
+        qvm_file_trust.clear_caches()
+
+        self.assertEqual(qvm_file_trust.evaluate_path(good),
+                qvm_file_trust.TrustVerdict(good, True, 'xattr', None))
+        with self.as_other_user():
+            self.assertEqual(qvm_file_trust.file_verdict(bad),
+                             (True, 'hash'))
+
+    def test_031_changed_locked_file(self):
+        """A locked file that changed isn't matched by its old digest"""
+        path, digest = self.make_hashed_file('good', b'good contents')
+        self.write_lines(self.trusted_list, [digest])
+        qvm_file_trust.change_file(path, False, rule='')
+
+        os.chmod(path, 0o600)
+        self.make_hashed_file('good', b'other contents')
+        os.chmod(path, 0)
+        qvm_file_trust.clear_caches()
+
+        with self.as_other_user():
+            self.assertIsNone(qvm_file_trust.file_digest(path))
+
+    def test_032_digest_index_compacted(self):
+        """The digest index is kept to the newest entries"""
+        paths = [self.make_hashed_file(str(i), b'contents')[0]
+                 for i in range(20)]
+
+        with unittest.mock.patch.object(qvm_file_trust,
+                'DIGEST_INDEX_MAX_SIZE', 1000):
+            for _ in range(3):
+                for path in paths:
+                    qvm_file_trust.save_locked_digest(path, '0' * 64)
+
+            self.assertLessEqual(os.path.getsize(
+                    qvm_file_trust.DIGEST_INDEX_LOC), 1000)
+
+        qvm_file_trust.clear_caches()
+        self.assertEqual(qvm_file_trust.locked_digest(os.stat(paths[-1])),
+                         '0' * 64)
+        self.assertIsNone(qvm_file_trust.locked_digest(os.stat(paths[0])))
+
+    def test_033_trusted_list_after_own_marking(self):
+        """Listed as trusted only overrides what the file's folder says"""
+        path, digest = self.make_hashed_file('good', b'good contents')
+        self.write_lines(self.trusted_list, [digest])
+        xattr.setxattr(path, 'user.qubes.untrusted', b'true')
+
+        self.assertEqual(qvm_file_trust.file_verdict(path), (True, 'xattr'))
+        self.assertIn(qvm_file_trust.evaluate_path(path),
+                      qvm_file_trust.check_directory(self.root))
+
+        xattr.removexattr(path, 'user.qubes.untrusted')
+        self.assertEqual(qvm_file_trust.file_verdict(path), (False, 'hash'))
+
+    def test_034_no_lists_no_hashing_on_lock(self):
+        """Locking a file doesn't hash it when there are no lists"""
+        path, _ = self.make_hashed_file('file', b'contents')
+
+        with unittest.mock.patch.object(qvm_file_trust, 'hash_file') as hash_file:
+            qvm_file_trust.change_file(path, False, rule='')
+
+        hash_file.assert_not_called()
+        self.assertEqual(os.stat(path).st_mode & 0o7777, 0)
+        self.assertFalse(os.path.exists(qvm_file_trust.DIGEST_INDEX_LOC))
+
+class TC_70_trust_record(TrustTestCase):
+    def setUp(self):
+        super().setUp()
+        self.incoming = os.path.join(self.root, 'QubesIncoming')
+        os.makedirs(os.path.join(self.incoming, 'work'))
+        self.path = self.make_file(os.path.join(self.incoming, 'work'),
+                                   'report.pdf')
+        os.chmod(self.path, 0o640)
+        self.patch(QUBES_INCOMING_LOC=self.incoming)
+
+    def mode(self):
+        return os.stat(self.path).st_mode & 0o7777
+
+    def test_000_round_trip(self):
+        """Records unpack to what was packed"""
+        for record in (
+                qvm_file_trust.TrustRecord(True, 'work', 1503792000,
+                    '/home/user/QubesIncoming', 0o644),
+                qvm_file_trust.TrustRecord(False, '', 0, '', None),
+                qvm_file_trust.TrustRecord(True, 'sys-usb', -1, 'phrase', 0)):
+            value = qvm_file_trust.pack_trust_record(record)
+            self.assertEqual(qvm_file_trust.parse_trust_record(value), record)
+
+    def test_001_legacy_values(self):
+        """The old 'true' and 'false' values are still understood"""
+        self.assertTrue(qvm_file_trust.parse_trust_record(b'true').untrusted)
+        self.assertFalse(qvm_file_trust.parse_trust_record(b'false').untrusted)
+        self.assertIsNone(qvm_file_trust.parse_trust_record(b'true').mode)
+
+    def test_002_unknown_values_untrusted(self):
+        """Values we can't parse are treated as untrusted"""
+        future = bytearray(qvm_file_trust.pack_trust_record(
+                qvm_file_trust.TrustRecord(False, '', 0, '', None)))
+        future[0] = qvm_file_trust.TRUST_RECORD_VERSION + 1
+
+        for value in (b'', b'yes', bytes(future),
+                qvm_file_trust.pack_trust_record(qvm_file_trust.TrustRecord(
+                    False, 'work', 0, '', None))[:-1]):
+            self.assertTrue(
+                    qvm_file_trust.parse_trust_record(value).untrusted)
+
+    def test_010_untrust_and_trust_restores_mode(self):
+        """Trusting a file gives back the permissions it had before"""
+        qvm_file_trust.change_file(self.path, False, rule='some rule')
+
+        self.assertEqual(self.mode(), 0)
+        record = qvm_file_trust.read_trust_record(self.path)
+        self.assertTrue(record.untrusted)
+        self.assertEqual(record.origin, 'work')
+        self.assertEqual(record.rule, 'some rule')
+        self.assertEqual(record.mode, 0o640)
+        self.assertAlmostEqual(record.timestamp, time.time(), delta=60)
+
+        # Marking it again keeps the original permissions
+        qvm_file_trust.change_file(self.path, False, rule='')
+        self.assertEqual(
+                qvm_file_trust.read_trust_record(self.path).mode, 0o640)
+
+        qvm_file_trust.change_file(self.path, True)
+
+        self.assertEqual(self.mode(), 0o640)
+        self.assertIsNone(qvm_file_trust.read_trust_record(self.path))
+
+    def test_011_trust_legacy_marked_file(self):
+        """Files locked by older versions get default permissions back"""
+        xattr.setxattr(self.path, 'user.qubes.untrusted', b'true')
+        os.chmod(self.path, 0)
+
+        qvm_file_trust.change_file(self.path, True)
+
+        self.assertEqual(self.mode(), qvm_file_trust.default_file_mode())
+
+    def test_012_rule_recorded(self):
+        """The untrusted folder a file is in is recorded as the rule"""
+        with unittest.mock.patch.object(qvm_file_trust, 'UNTRUSTED_RULES',
+                (frozenset([self.incoming]), '')):
+            qvm_file_trust.change_file(self.path, False)
+
+        self.assertEqual(qvm_file_trust.read_trust_record(self.path).rule,
+                self.incoming)
+
+    def test_013_origin_outside_incoming(self):
+        """Files outside ~/QubesIncoming have no origin qube"""
+        self.assertEqual(qvm_file_trust.origin_vm(self.path), 'work')
+        self.assertEqual(qvm_file_trust.origin_vm(self.root), '')
+        self.assertEqual(qvm_file_trust.origin_vm(
+                os.path.join(self.incoming, 'loose-file')), '')
+
+    def test_014_trust_fails_stays_locked(self):
+        """A file whose marker can't be removed stays locked"""
+        qvm_file_trust.change_file(self.path, False, rule='')
+
+        with unittest.mock.patch('xattr.removexattr',
+                side_effect=OSError(errno.EPERM, 'Operation not permitted')), \
+             self.assertRaises(SystemExit) as cm:
+            qvm_file_trust.change_file(self.path, True)
+
+        self.assertEqual(cm.exception.code, 65)
+        self.assertEqual(self.mode(), 0)
+        self.assertTrue(qvm_file_trust.read_trust_record(self.path).untrusted)
+
+class TC_80_output_format(TrustTestCase):
+    def setUp(self):
+        super().setUp()
+        self.patch(OUTPUT_QUIET=False)
+        self.untrusted = os.path.join(self.root, 'untrusted')
+        os.mkdir(self.untrusted)
+        self.write_rules([self.untrusted], [], ['.dodgy'])
+
+        self.trusted_file = self.make_file(self.root, 'plain')
+        self.rule_file = self.make_file(self.untrusted, 'in-rule')
+        self.phrase_file = self.make_file(self.root, 'file.DODGY')
+        self.marked_file = self.make_file(self.root, 'marked')
+        xattr.setxattr(self.marked_file, 'user.qubes.untrusted', b'true')
+        self.missing_file = os.path.join(self.root, 'gone')
+
+    def test_000_verdict_sources(self):
+        """Each verdict names the check that decided it"""
+        expected = {
+            self.trusted_file: (False, None, None),
+            self.rule_file: (True, 'folder-rule', None),
+            self.phrase_file: (True, 'phrase', None),
+            self.marked_file: (True, 'xattr', None),
+            self.untrusted: (True, 'folder-rule', None),
+            self.root: (False, None, None),
+        }
+
+        for path, (untrusted, source, err) in expected.items():
+            self.assertEqual(qvm_file_trust.evaluate_path(path),
+                    qvm_file_trust.TrustVerdict(path, untrusted, source, err))
+
+        verdict = qvm_file_trust.evaluate_path(self.missing_file)
+        self.assertIsNone(verdict.untrusted)
+        self.assertTrue(verdict.error)
+
+    def test_010_jsonl(self):
+        """--format=jsonl prints one JSON object per path, in order"""
+        paths = [self.trusted_file, self.rule_file, self.missing_file]
+        code, output = self.run_main('--format=jsonl', *paths)
+
+        records = [json.loads(line) for line in output.decode().splitlines()]
+        self.assertEqual([record['path'] for record in records], paths)
+        self.assertEqual([record['verdict'] for record in records],
+                ['trusted', 'untrusted', 'error'])
+        self.assertEqual(records[1]['source'], 'folder-rule')
+        self.assertIsNone(records[0]['error'])
+        self.assertTrue(records[2]['error'])
+
+        # Errors count as untrusted
+        self.assertEqual(code, 1)
+
+    def test_011_nul(self):
+        """--format=nul prints four NUL terminated fields per path"""
+        code, output = self.run_main('--format', 'nul', self.trusted_file,
+                self.phrase_file)
+
+        self.assertEqual(output.split(b'\0'), [
+                os.fsencode(self.trusted_file), b'trusted', b'', b'',
+                os.fsencode(self.phrase_file), b'untrusted', b'phrase', b'',
+                b''])
+        self.assertEqual(code, 1)
+
+    def test_012_exit_codes(self):
+        """Exit codes follow --check-multiple and its all-untrusted variant"""
+        self.assertEqual(self.run_main('-f', 'jsonl', self.trusted_file)[0], 0)
+        self.assertEqual(self.run_main('-f', 'jsonl', self.rule_file)[0], 1)
+        self.assertEqual(self.run_main('-f', 'jsonl', '-D', self.rule_file,
+                self.trusted_file)[0], 0)
+        self.assertEqual(self.run_main('-f', 'jsonl', '-D', self.rule_file,
+                self.marked_file)[0], 1)
+
+    def test_013_quiet(self):
+        """--quiet still sets the exit code but prints nothing"""
+        self.assertEqual(self.run_main('-q', '-f', 'jsonl', self.rule_file),
+                (1, b''))
+
+    def test_020_chunked_writes(self):
+        """Large batches are written a chunk at a time"""
+        verdicts = [qvm_file_trust.TrustVerdict(str(i), False, None, None)
+                    for i in range(qvm_file_trust.OUTPUT_CHUNK_SIZE * 2 + 1)]
+
+        stdout = unittest.mock.MagicMock()
+        with unittest.mock.patch('sys.stdout', stdout):
+            self.assertEqual(qvm_file_trust.write_verdicts(verdicts, 'jsonl'),
+                    (False, False))
+
+        self.assertEqual(stdout.buffer.write.call_count, 3)
+        written = b''.join(call[0][0]
+                for call in stdout.buffer.write.call_args_list)
+        self.assertEqual(len(written.splitlines()), len(verdicts))
+
+class TC_90_rules_generation(TrustTestCase):
+    def setUp(self):
+        super().setUp()
+        self.state = os.path.join(self.root, 'config', 'state')
+        self.patch(RULES_STATE_LOC=self.state)
+        self.folders = [os.path.join(self.root, name)
+                        for name in ('a', 'b', 'c', 'd')]
+        for folder in self.folders:
+            os.mkdir(folder)
+        self.write_rules([self.folders[0]], [self.folders[1]])
+
+    def test_000_generation_stable(self):
+        """The generation only changes with the rules"""
+        generation, digest = qvm_file_trust.rules_generation()
+
+        self.assertEqual(qvm_file_trust.rules_generation(),
+                (generation, digest))
+
+        # Rewriting the same rules is a new file but not a new generation
+        self.write_rules([self.folders[0]], [self.folders[1]])
+        self.assertEqual(qvm_file_trust.rules_generation(),
+                (generation, digest))
+
+    def test_001_unchanged_check_is_cheap(self):
+        """An up to date state is answered without reading the rules"""
+        qvm_file_trust.rules_generation()
+
+        with unittest.mock.patch.object(qvm_file_trust,
+                'retrieve_untrusted_folders') as retrieve:
+            qvm_file_trust.rules_generation()
+
+        retrieve.assert_not_called()
+
+    def test_002_hand_edits_detected(self):
+        """Editing a list by hand starts a new generation"""
+        generation, digest = qvm_file_trust.rules_generation()
+
+        self.write_rules([self.folders[0]], [self.folders[1],
+                self.folders[2]])
+
+        new_generation, new_digest = qvm_file_trust.rules_generation()
+        self.assertEqual(new_generation, generation + 1)
+        self.assertNotEqual(new_digest, digest)
+
+    def test_003_change_folder_bumps_generation(self):
+        """Writing rules with change_folder starts a new generation"""
+        generation, _ = qvm_file_trust.rules_generation()
+
+        with unittest.mock.patch('os.makedirs'):
+            qvm_file_trust.change_folder(self.folders[3], False)
+
+        with open(self.state) as state_file:
+            self.assertEqual(int(state_file.readline().split()[0]),
+                    generation + 1)
+
+    def test_010_diff(self):
+        """Diffs combine every change since the given generation"""
+        first, _ = qvm_file_trust.rules_generation()
+        self.assertEqual(qvm_file_trust.rules_diff_since(first),
+                (set(), set(), None))
+        self.assertEqual(qvm_file_trust.rules_diff_since(0),
+                (set(self.folders[:2]), set(), None))
+
+        self.write_rules([self.folders[0]], [self.folders[2]])
+        second, _ = qvm_file_trust.rules_generation()
+        self.write_rules([self.folders[0]], [self.folders[1],
+                self.folders[3]])
+
+        self.assertEqual(qvm_file_trust.rules_diff_since(second),
+                ({self.folders[1], self.folders[3]}, {self.folders[2]},
+                 None))
+
+        # Folders added then removed again cancel out
+        self.assertEqual(qvm_file_trust.rules_diff_since(first),
+                ({self.folders[3]}, set(), None))
+
+    def test_011_old_diffs_forgotten(self):
+        """Only the last RULES_HISTORY_LENGTH generations can be diffed"""
+        with unittest.mock.patch.object(qvm_file_trust,
+                'RULES_HISTORY_LENGTH', 2):
+            first, _ = qvm_file_trust.rules_generation()
+            for folder in self.folders[1:]:
+                self.write_rules([folder], [])
+                last, _ = qvm_file_trust.rules_generation()
+
+            self.assertIsNone(qvm_file_trust.rules_diff_since(first))
+            self.assertIsNotNone(qvm_file_trust.rules_diff_since(last - 2))
+            self.assertIsNone(qvm_file_trust.rules_diff_since(last + 1))
+
+    def test_012_phrase_diff(self):
+        """Diffs include the phrase when it was set since"""
+        first, _ = qvm_file_trust.rules_generation()
+
+        self.write_rules(self.folders[:1], self.folders[1:2], ['.odd'])
+        second, _ = qvm_file_trust.rules_generation()
+        self.write_rules(self.folders[:1], self.folders[1:2], ['.dodgy'])
+        third, _ = qvm_file_trust.rules_generation()
+
+        self.assertEqual(third, first + 2)
+        self.assertEqual(qvm_file_trust.rules_diff_since(first),
+                (set(), set(), '.dodgy'))
+        self.assertEqual(qvm_file_trust.rules_diff_since(second),
+                (set(), set(), '.dodgy'))
+        self.assertEqual(qvm_file_trust.rules_diff_since(third),
+                (set(), set(), None))
+
+        # Clearing the phrase is a change too
+        self.write_rules(self.folders[:1], self.folders[1:2])
+        self.assertEqual(qvm_file_trust.rules_diff_since(third),
+                (set(), set(), ''))
+
+    def test_013_updates_locked(self):
+        """An update waits for whoever else is updating the state"""
+        generation, _ = qvm_file_trust.rules_generation()
+        self.write_rules([self.folders[0]], [self.folders[2]])
+
+        results = []
+        lock_file = qvm_file_trust.lock_rules_state()
+        thread = threading.Thread(target=lambda:
+                results.append(qvm_file_trust.update_rules_state()[0]))
+        thread.start()
+        thread.join(0.2)
+        self.assertTrue(thread.is_alive())
+
+        lock_file.close()
+        thread.join()
+        self.assertEqual(results, [generation + 1])
+
+    def test_020_refresh_reloads_stale_rules(self):
+        """Long-lived callers pick up rules from a newer generation"""
+        path = os.path.join(self.folders[2], 'file')
+        self.assertFalse(qvm_file_trust.is_untrusted_path(path))
+
+        self.write_rules([self.folders[2]], [])
+
+        # Without refreshing, the rules loaded earlier are still used
+        self.assertFalse(qvm_file_trust.is_untrusted_path(path))
+        qvm_file_trust.load_untrusted_rules(refresh=True)
+        self.assertTrue(qvm_file_trust.is_untrusted_path(path))
+
+class TC_95_check_dir(TrustTestCase):
+    def setUp(self):
+        super().setUp()
+        self.patch(OUTPUT_QUIET=False)
+
+        self.folder = os.path.join(self.root, 'listing')
+        self.untrusted = os.path.join(self.folder, 'untrusted')
+        self.exact_rule = os.path.join(self.folder, 'exact-rule')
+        self.marked_folder = os.path.join(self.folder, 'marked-folder')
+        self.cleared_folder = os.path.join(self.marked_folder, 'cleared')
+        for folder in (self.folder, self.untrusted, self.exact_rule,
+                       self.marked_folder, self.cleared_folder):
+            os.mkdir(folder)
+        xattr.setxattr(self.marked_folder, 'user.qubes.untrusted', b'true')
+        xattr.setxattr(self.cleared_folder, 'user.qubes.untrusted', b'false')
+
+        self.write_rules([self.untrusted, self.exact_rule], [], ['.dodgy'])
+
+        self.make_file(self.folder, 'listed-by-hash', b'bad contents')
+        self.write_lines(self.untrusted_list,
+                         [hashlib.sha256(b'bad contents').hexdigest()])
+
+        self.make_file(self.folder, 'plain')
+        self.make_file(self.folder, 'file.DODGY')
+        self.make_file(self.untrusted, 'in-rule')
+        self.make_file(self.marked_folder, 'inherits')
+        self.make_file(self.cleared_folder, 'cleared-file')
+        self.make_file(self.cleared_folder, 'cleared.dodgy')
+        marked = self.make_file(self.folder, 'marked')
+        xattr.setxattr(marked, 'user.qubes.untrusted', b'true')
+        cleared = self.make_file(self.marked_folder, 'marked-trusted')
+        xattr.setxattr(cleared, 'user.qubes.untrusted', b'false')
+        self.link_to_rule = os.path.join(self.folder, 'link-to-rule')
+        os.symlink(os.path.join(self.untrusted, 'in-rule'), self.link_to_rule)
+        os.symlink(self.untrusted, os.path.join(self.folder, 'link-to-folder'))
+        os.symlink(os.path.join(self.root, 'gone'),
+                   os.path.join(self.folder, 'dangling'))
+        self.link_out = os.path.join(self.exact_rule, 'link-out')
+        os.symlink(self.cleared_folder, self.link_out)
+
+    def per_file(self, folder):
+        return [qvm_file_trust.evaluate_path(os.path.join(folder, name))
+                for name in sorted(os.listdir(folder))]
+
+    def test_000_matches_per_file_checks(self):
+        """Every entry gets the verdict it would get when checked alone"""
+        for folder in (self.folder, self.untrusted, self.exact_rule,
+                       self.marked_folder, self.cleared_folder,
+                       self.link_out):
+            self.assertEqual(qvm_file_trust.check_directory(folder),
+                             self.per_file(folder))
+
+    def test_001_unreadable_folder_marker(self):
+        """A folder whose marker can't be read gets the verdict it would
+        get when checked alone"""
+        get_xattr = xattr.get
+
+        def failing_get(path, name):
+            if os.path.basename(path) == 'marked-folder':
+                raise OSError(errno.EACCES, os.strerror(errno.EACCES), path)
+            return get_xattr(path, name)
+
+        with unittest.mock.patch('xattr.get', failing_get):
+            listing = qvm_file_trust.check_directory(self.folder)
+            qvm_file_trust.clear_caches()
+            per_file = self.per_file(self.folder)
+
+        self.assertEqual(listing, per_file)
+        verdicts = {os.path.basename(verdict.path): verdict
+                    for verdict in listing}
+        self.assertEqual(verdicts['marked-folder'],
+                qvm_file_trust.TrustVerdict(self.marked_folder, False, None,
+                                            None))
+
+    def test_002_verdict_sources(self):
+        """Each source of untrust is picked up from a listing"""
+        verdicts = {os.path.basename(verdict.path): verdict
+                    for verdict in qvm_file_trust.check_directory(self.folder)}
+
+        expected = {
+            'plain': (False, None),
+            'file.DODGY': (True, 'phrase'),
+            'listed-by-hash': (True, 'hash'),
+            'marked': (True, 'xattr'),
+            'untrusted': (True, 'folder-rule'),
+            'exact-rule': (True, 'folder-rule'),
+            'marked-folder': (True, 'folder-xattr'),
+            'link-to-rule': (True, 'folder-rule'),
+            'link-to-folder': (True, 'folder-rule'),
+        }
+        for name, (untrusted, source) in expected.items():
+            self.assertEqual((verdicts[name].untrusted, verdicts[name].source),
+                             (untrusted, source), name)
+
+        self.assertIsNone(verdicts['dangling'].untrusted)
+        self.assertTrue(verdicts['dangling'].error)
+
+    def test_003_relative_path(self):
+        """Verdicts keep the path the folder was given as"""
+        cwd = os.getcwd()
+        self.addCleanup(os.chdir, cwd)
+        os.chdir(self.root)
+
+        verdicts = qvm_file_trust.check_directory('listing')
+        self.assertEqual(verdicts, self.per_file(self.folder))
+
+    def test_004_not_a_folder(self):
+        """Listing a file or a missing folder raises OSError"""
+        with self.assertRaises(OSError):
+            qvm_file_trust.check_directory(os.path.join(self.folder, 'plain'))
+        with self.assertRaises(OSError):
+            qvm_file_trust.check_directory(os.path.join(self.root, 'gone'))
+
+    def test_010_command_line(self):
+        """--check-dir prints a line per entry and exits like -C"""
+        code, output = self.run_main('--check-dir', '--format=jsonl',
+                                     self.untrusted)
+
+        self.assertEqual(code, 1)
+        self.assertEqual([json.loads(line) for line in output.splitlines()],
+                [{'path': os.path.join(self.untrusted, 'in-rule'),
+                  'verdict': 'untrusted', 'source': 'folder-rule',
+                  'error': None}])
+
+        code, output = self.run_main('--check-dir', self.cleared_folder)
+
+        self.assertEqual(code, 1)
+        self.assertEqual(output.decode().splitlines(), [
+                os.path.join(self.cleared_folder, 'cleared-file') +
+                ': Trusted',
+                os.path.join(self.cleared_folder, 'cleared.dodgy') +
+                ': Untrusted'])
+
+    def test_011_bad_arguments(self):
+        """--check-dir can't change trust, and needs a folder"""
+        self.assertEqual(self.run_main('--check-dir', '--untrusted',
+                                       self.folder)[0], 64)
+        self.assertEqual(self.run_main('-q', '--check-dir',
+                os.path.join(self.folder, 'plain')), (65, b''))
+
+    def test_012_pending_in_daemon(self):
+        """Files queued in the daemon are untrusted, with a single query for
+        the folder"""
+        self.start_daemon(lambda query: b'in-rule\0\n'
+                          if query.startswith(b'LIST ') else b'UNKNOWN\n')
+
+        self.assertEqual(qvm_file_trust.check_directory(self.untrusted),
+                [qvm_file_trust.TrustVerdict(
+                        os.path.join(self.untrusted, 'in-rule'), True,
+                        'daemon', None)])
+        self.assertEqual(self.daemon_queries,
+                         [b'LIST ' + os.fsencode(self.untrusted) + b'\n'])
+
+        # The daemon only watches untrusted folders, so files elsewhere are
+        # left alone. Only the symlink, which leads into one, is asked about
+        del self.daemon_queries[:]
+        verdicts = {os.path.basename(verdict.path): verdict
+                    for verdict in qvm_file_trust.check_directory(self.folder)}
+        self.assertEqual(verdicts['plain'].untrusted, False)
+        self.assertEqual(self.daemon_queries, [os.fsencode(
+                os.path.join(self.untrusted, 'in-rule')) + b'\n'])
+
+    def test_020_large_folder(self):
+        """Checking a large folder at once only resolves it and asks the
+        daemon about it once, instead of for each file"""
+        folder = os.path.join(self.untrusted, 'large')
+        os.mkdir(folder)
+        for i in range(2000):
+            self.make_file(folder, str(i))
+        self.start_daemon(lambda query: b'\n' if query.startswith(b'LIST ')
+                          else b'UNKNOWN\n')
+
+        with unittest.mock.patch.object(qvm_file_trust, 'canonical_path',
+                wraps=qvm_file_trust.canonical_path) as canonical_path:
+            per_file = self.per_file(folder)
+        self.assertGreaterEqual(canonical_path.call_count, 2000)
+        self.assertEqual(len(self.daemon_queries), 2000)
+
+        del self.daemon_queries[:]
+        with unittest.mock.patch.object(qvm_file_trust, 'canonical_path',
+                wraps=qvm_file_trust.canonical_path) as canonical_path:
+            listing = qvm_file_trust.check_directory(folder)
+
+        self.assertEqual(listing, per_file)
+        self.assertEqual(canonical_path.call_count, 1)
+        self.assertEqual(len(self.daemon_queries), 1)
+
 def list_tests():
     return (
             TC_00_trust,
-            TC_10_misc
+            TC_10_misc,
+            TC_20_daemon,
+            TC_30_open_in_dispvm,
+            TC_40_folder_xattr,
+            TC_50_canonical_paths,
+            TC_60_content_hash,
+            TC_70_trust_record,
+            TC_80_output_format,
+            TC_90_rules_generation,
+            TC_95_check_dir
     )
 
 if __name__ == '__main__':